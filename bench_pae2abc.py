@@ -0,0 +1,374 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+# Benchmarks for pae2abc, on a synthetic corpus of RISM-like incipits
+
+# The corpus is generated from a seed, so two runs (or two versions of
+# the converter) time exactly the same input.  Results can be saved to
+# a json file and compared against a later run:
+#
+#   bench_pae2abc.py -o before.json
+#   ... change pae2abc.py ...
+#   bench_pae2abc.py -o after.json --compare before.json
+
+# Released under GPLv3 or later
+
+from __future__ import print_function, division
+
+import os
+import sys
+import json
+import random
+import timeit
+import argparse
+import tempfile
+import platform
+
+import pae2abc
+
+clefs = ['G-2', 'G-2', 'G-2', 'C-1', 'C-3', 'C-4', 'F-4', 'g-2']
+keys = ['', '', 'bB', 'bBE', 'bBEA', 'xF', 'xFC', 'xFCG', 'xFCGD']
+timesigs = ['c', 'c', 'c/', '2/4', '3/4', '3/4', '4/4', '3/8', '6/8', '3/2']
+octaves = ["'", "''", "''", "'''", ',']
+lengths = ['8', '8', '4', '4', '2', '6', '8.', '4.', '3', '1']
+rhythmic_models = ['8.6', '86', '4.8', '6688', '3333', '48']
+
+# Incipit sizes, in measures.  Most of the catalog has a few measures;
+# a few records are much longer, and some are pathological.
+sizes = [
+    ('typical', 0.80, 2, 8),
+    ('long', 0.15, 12, 40),
+    ('pathological', 0.05, 150, 600),
+    ]
+
+# Incipit sizes, in measures, to see how time grows with length
+scaling_sizes = [2, 8, 32, 128, 512]
+
+
+def random_notes(rng, count):
+    '''Return count notes, some of them with octave or accidental'''
+    notes = ''
+    for n in range(count):
+        if rng.random() < 0.2:
+            notes += rng.choice(octaves)
+        if rng.random() < 0.1:
+            notes += rng.choice('xbn')
+        notes += rng.choice('CDEFGAB')
+    return notes
+
+
+def random_construct(rng):
+    '''Return a piece of pae tune, using one of the constructs that
+    the converter knows about'''
+    construct = rng.choice([
+        'notes', 'notes', 'notes', 'notes', 'rhythmic_model', 'tuplet',
+        'fermata', 'repetition', 'chord', 'acciaccatura', 'appoggiatura',
+        'grace_group', 'beam', 'rest', 'slur', 'trill',
+        ])
+    length = rng.choice(lengths)
+    if construct == 'notes':
+        return length + random_notes(rng, rng.randint(1, 4))
+    elif construct == 'rhythmic_model':
+        return rng.choice(rhythmic_models) + random_notes(rng, 4)
+    elif construct == 'tuplet':
+        if rng.random() < 0.5:
+            return '6(%s)' % (random_notes(rng, 3))
+        return '(6%s;5)' % (random_notes(rng, 5))
+    elif construct == 'fermata':
+        return '%s(%s)' % (length, random_notes(rng, 1))
+    elif construct == 'repetition':
+        return '!%s%s!%s' % (length, random_notes(rng, rng.randint(1, 3)),
+                             'f' * rng.randint(1, 3))
+    elif construct == 'chord':
+        return length + '^'.join(random_notes(rng, 1)
+                                 for n in range(rng.randint(2, 4)))
+    elif construct == 'acciaccatura':
+        return 'g%s%s%s' % (random_notes(rng, 1), length,
+                            random_notes(rng, 1))
+    elif construct == 'appoggiatura':
+        return 'q%s%s%s' % (random_notes(rng, 1), length,
+                            random_notes(rng, 1))
+    elif construct == 'grace_group':
+        return 'qq6%sr%s%s' % (random_notes(rng, 3), length,
+                               random_notes(rng, 1))
+    elif construct == 'beam':
+        return '{6%s}' % (random_notes(rng, 4))
+    elif construct == 'rest':
+        return length + '-'
+    elif construct == 'slur':
+        return '%s%s+%s' % (length, random_notes(rng, 1),
+                            random_notes(rng, 1))
+    elif construct == 'trill':
+        return '%st%s' % (length, random_notes(rng, 1))
+
+
+def random_incipit(rng, measures):
+    '''Return a pae incipit of the given number of measures'''
+    pae = '%%%s$%s@%s ' % (rng.choice(clefs), rng.choice(keys),
+                           rng.choice(timesigs))
+    for n in range(measures):
+        choice = rng.random()
+        if n and choice < 0.08:
+            # Repeat the previous measure
+            pae += 'i/'
+            continue
+        elif n and choice < 0.10:
+            pae += '=%d/' % (rng.randint(1, 4))
+            continue
+        elif n and choice < 0.12:
+            # Clef, key or meter change in the middle of the tune
+            pae += rng.choice(['%%%s ' % (rng.choice(clefs)),
+                               '$%s ' % (rng.choice(keys)),
+                               '@%s ' % (rng.choice(timesigs))])
+        for m in range(rng.randint(1, 3)):
+            pae += random_construct(rng)
+        pae += '/'
+    return pae
+
+
+def random_record(rng, number, measures):
+    '''Return the lines of a pae record, with some information
+    fields, as read by read_pae_records()'''
+    lines = [
+        'C: Composer %d' % (rng.randint(1, 500)),
+        'T: Title %d' % (number),
+        'P: %09d' % (rng.randint(1, 10**9 - 1)),
+        random_incipit(rng, measures),
+        ]
+    return lines
+
+
+def generate_corpus(seed, records):
+    '''Return a list of (size name, lines) records, always the same for
+    the same seed'''
+    rng = random.Random(seed)
+    corpus = []
+    for number in range(1, records + 1):
+        choice = rng.random()
+        for (name, share, shortest, longest) in sizes:
+            if choice < share:
+                break
+            choice -= share
+        measures = rng.randint(shortest, longest)
+        corpus.append((name, random_record(rng, number, measures)))
+    return corpus
+
+
+def tune_segments(pae):
+    '''Return the tune parts of a pae string, as parse_pae() passes
+    them to tune2abc()'''
+    segments = []
+    position = 0
+    while position < len(pae):
+        c = pae[position]
+        position += 1
+        if c == ' ':
+            end = pae2abc.scan_run(pae, position,
+                                   pae2abc.valid_pae_chars['tune'])
+            segments.append(pae[position:end])
+            position = end
+    return segments
+
+
+def best_time(function, repeat):
+    '''Return the best of repeat runs of function, in seconds'''
+    best = None
+    for n in range(repeat):
+        start = timeit.default_timer()
+        function()
+        elapsed = timeit.default_timer() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def throughput(seconds, records, chars):
+    return {
+        'seconds': seconds,
+        'records': records,
+        'chars': chars,
+        'records_per_sec': records / seconds,
+        'chars_per_sec': chars / seconds,
+        }
+
+
+def bench_pae2abc(paes, repeat):
+    def run():
+        for pae in paes:
+            pae2abc.pae2abc(pae)
+    chars = sum(len(pae) for pae in paes)
+    return throughput(best_time(run, repeat), len(paes), chars)
+
+
+def bench_tune2abc(paes, repeat):
+    segments = []
+    for pae in paes:
+        segments.extend(tune_segments(pae))
+
+    def run():
+        for tune in segments:
+            pae2abc.tune2abc(tune)
+    chars = sum(len(tune) for tune in segments)
+    return throughput(best_time(run, repeat), len(segments), chars)
+
+
+def bench_convert_pae_file(corpus, repeat):
+    (fd, filename) = tempfile.mkstemp(suffix='.pae')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            for (name, lines) in corpus:
+                for line in lines:
+                    f.write(line + '\n')
+        chars = os.path.getsize(filename)
+        with open(os.devnull, 'w') as out:
+            def run():
+                pae2abc.convert_pae_file(filename, out)
+            seconds = best_time(run, repeat)
+    finally:
+        os.remove(filename)
+    return throughput(seconds, len(corpus), chars)
+
+
+def bench_scaling(seed, records, repeat):
+    '''Time pae2abc() on incipits of growing length; a per char time
+    that does not grow means that conversion time is linear'''
+    rng = random.Random(seed)
+    scaling = []
+    for measures in scaling_sizes:
+        paes = [random_incipit(rng, measures) for n in range(records)]
+        result = bench_pae2abc(paes, repeat)
+        result['measures'] = measures
+        result['us_per_record'] = 1e6 * result['seconds'] / records
+        result['ns_per_char'] = 1e9 * result['seconds'] / result['chars']
+        scaling.append(result)
+    return scaling
+
+
+def run_benchmarks(args):
+    corpus = generate_corpus(args.seed, args.records)
+    paes = [lines[-1] for (name, lines) in corpus]
+    results = {
+        'version': pae2abc.converter_version(),
+        'python': platform.python_version(),
+        'seed': args.seed,
+        'records': args.records,
+        'repeat': args.repeat,
+        'benchmarks': {},
+        'sizes': {},
+        'scaling': [],
+        }
+    benchmarks = results['benchmarks']
+    benchmarks['pae2abc'] = bench_pae2abc(paes, args.repeat)
+    benchmarks['tune2abc'] = bench_tune2abc(paes, args.repeat)
+    benchmarks['convert_pae_file'] = bench_convert_pae_file(corpus,
+                                                            args.repeat)
+    for (name, share, shortest, longest) in sizes:
+        subset = [lines[-1] for (size, lines) in corpus if size == name]
+        if subset:
+            results['sizes'][name] = bench_pae2abc(subset, args.repeat)
+    results['scaling'] = bench_scaling(args.seed, args.scaling_records,
+                                       args.repeat)
+    return results
+
+
+def print_results(results):
+    print('pae2abc %s, python %s, seed %s, %s records, best of %s' %
+          (results['version'][:12], results['python'], results['seed'],
+           results['records'], results['repeat']))
+    print()
+    print('%-20s %10s %12s %14s' % ('benchmark', 'seconds', 'records/s',
+                                    'chars/s'))
+    for group in ('benchmarks', 'sizes'):
+        for name in sorted(results[group]):
+            result = results[group][name]
+            print('%-20s %10.3f %12.0f %14.0f' %
+                  (name, result['seconds'], result['records_per_sec'],
+                   result['chars_per_sec']))
+    print()
+    print('%-20s %10s %12s %14s' % ('measures', 'avg chars', 'us/record',
+                                    'ns/char'))
+    for result in results['scaling']:
+        print('%-20s %10.0f %12.1f %14.1f' %
+              (result['measures'], result['chars'] / result['records'],
+               result['us_per_record'], result['ns_per_char']))
+    scaling = results['scaling']
+    if len(scaling) > 1:
+        growth = scaling[-1]['ns_per_char'] / scaling[0]['ns_per_char']
+        print('per char time grows x%.2f from %s to %s measures '
+              '(1.00 is linear)' % (growth, scaling[0]['measures'],
+                                    scaling[-1]['measures']))
+
+
+def compare_results(old, new, tolerance):
+    '''Print the speed of new relative to old, and return the number of
+    benchmarks that got slower than tolerance allows'''
+    if old['seed'] != new['seed'] or old['records'] != new['records']:
+        print('warning: results come from different corpora',
+              file=sys.stderr)
+    print()
+    print('%-20s %12s %12s %8s' % ('benchmark', 'old chars/s',
+                                   'new chars/s', 'speedup'))
+    regressions = 0
+    for group in ('benchmarks', 'sizes'):
+        for name in sorted(new[group]):
+            if name not in old.get(group, {}):
+                continue
+            before = old[group][name]['chars_per_sec']
+            after = new[group][name]['chars_per_sec']
+            speedup = after / before
+            mark = ''
+            if speedup < 1 - tolerance:
+                mark = ' slower'
+                regressions += 1
+            print('%-20s %12.0f %12.0f %7.2fx%s' %
+                  (name, before, after, speedup, mark))
+    return regressions
+
+
+def main(args):
+    if args.write_corpus:
+        with open(args.write_corpus, 'w') as f:
+            for (name, lines) in generate_corpus(args.seed, args.records):
+                for line in lines:
+                    f.write(line + '\n')
+        return 0
+
+    results = run_benchmarks(args)
+    print_results(results)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=1, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as f:
+            old = json.load(f)
+        if compare_results(old, results, args.tolerance):
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Benchmark pae2abc on a synthetic corpus')
+    parser.add_argument('-s', '--seed', type=int, default=1,
+                        help='seed of the synthetic corpus')
+    parser.add_argument('-n', '--records', type=int, default=2000,
+                        help='number of records of the corpus')
+    parser.add_argument('--scaling-records', type=int, default=20,
+                        metavar='N',
+                        help='number of records of each length to time '
+                        'how conversion time grows')
+    parser.add_argument('-r', '--repeat', type=int, default=3,
+                        help='time each benchmark REPEAT times, and keep '
+                        'the best')
+    parser.add_argument('-o', '--output', metavar='FILE',
+                        help='save the results to a json file')
+    parser.add_argument('-c', '--compare', metavar='FILE',
+                        help='compare with the results of a previous run, '
+                        'and exit with 1 if something got slower')
+    parser.add_argument('-t', '--tolerance', type=float, default=0.10,
+                        help='slowdown allowed by --compare, as a fraction')
+    parser.add_argument('--write-corpus', metavar='FILE',
+                        help='write the synthetic corpus as a pae file and '
+                        'exit, without timing anything')
+    args = parser.parse_args()
+    sys.exit(main(args))
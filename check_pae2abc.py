@@ -0,0 +1,285 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+# Equivalence checks for pae2abc, on the synthetic corpus of
+# bench_pae2abc.py
+
+# The faster ways of converting must give exactly what the plain
+# conversion gives: an IncrementalConversion after random edits, the
+# same as converting the edited pae string again, and its diff(), the
+# edit of the abc; and --jobs, --shard, --checkpoint (interrupted and
+# resumed) and --manifest, byte for byte the same output file.  Run it
+# after changing the converter:
+#
+#   check_pae2abc.py
+#   check_pae2abc.py -s 2 -n 5000 --edits 20
+
+# Released under GPLv3 or later
+
+from __future__ import print_function, division
+
+import io
+import os
+import sys
+import random
+import shutil
+import argparse
+import tempfile
+
+import pae2abc
+import bench_pae2abc
+
+# Characters that random edits insert
+edit_chars = "CDEFGAB ',0123456789.xbngqr-=/:t+^();{}!fi%$@"
+
+
+class Interrupted(Exception):
+    '''Raised to stop a checkpointed conversion halfway'''
+
+
+class InterruptedCheckpoint(pae2abc.Checkpoint):
+    '''A checkpoint that interrupts the conversion after it has been
+    saved a given number of times, as a crash would'''
+
+    def __init__(self, filename, every, saves):
+        pae2abc.Checkpoint.__init__(self, filename, every)
+        self.saves = saves
+
+    def save(self, state):
+        pae2abc.Checkpoint.save(self, state)
+        self.saves -= 1
+        if self.saves < 0:
+            raise Interrupted()
+
+
+def outcome(convert, *args):
+    '''Return the abc structure that convert returns, or the name of
+    the exception it raises'''
+    try:
+        return convert(*args)
+    except Exception as error:
+        return type(error).__name__
+
+
+def random_edit(rng, pae):
+    '''Return a random (offset, deleted, inserted) edit of pae, often
+    typing at its end, as when it is being written'''
+    if rng.random() < 0.3:
+        offset = len(pae)
+        deleted = 0
+    else:
+        offset = rng.randint(0, len(pae))
+        deleted = min(rng.choice([0, 0, 1, 2, rng.randint(0, 10)]),
+                      len(pae) - offset)
+    inserted = ''.join(rng.choice(edit_chars)
+                       for n in range(rng.choice([0, 1, 1, 2, 5])))
+    return (offset, deleted, inserted)
+
+
+def check_incremental(paes, seed, edits):
+    '''Edit each pae string at random, edits times, and return the
+    number of edits and of mismatches: the IncrementalConversion must
+    convert as convert_pae() does, and its diff() from the conversion
+    before must turn the abc tune before into the new one'''
+    rng = random.Random(seed)
+    count = 0
+    failed = 0
+    for pae in paes:
+        try:
+            conversion = pae2abc.IncrementalConversion(pae)
+            conversion.tune()
+        except Exception:
+            continue
+        for n in range(edits):
+            (offset, deleted, inserted) = random_edit(rng, conversion.pae)
+            edited = (conversion.pae[:offset] + inserted +
+                      conversion.pae[offset + deleted:])
+            count += 1
+            try:
+                following = conversion.edit(offset, deleted, inserted)
+                result = following.convert()
+            except Exception as error:
+                following = None
+                result = type(error).__name__
+            if result != outcome(pae2abc.convert_pae, edited):
+                failed += 1
+                print('edit %r of %r: %r, %r, %r converts differently' %
+                      (edited, conversion.pae, offset, deleted, inserted),
+                      file=sys.stderr)
+                break
+            if following is None:
+                # Nothing to go on from
+                break
+            (start, removed, added) = following.diff(conversion)
+            old = conversion.tune()
+            if old[:start] + added + old[start + removed:] != \
+               following.tune():
+                failed += 1
+                print('diff of edit %r of %r is wrong' %
+                      (edited, conversion.pae), file=sys.stderr)
+                break
+            conversion = following
+    return (count, failed)
+
+
+def write_corpus(corpus, filename):
+    '''Write the corpus as a pae file, giving every fifth record an X
+    field, so that automatic X numbers follow ones from the file'''
+    with io.open(filename, 'w', encoding='utf-8') as f:
+        for (n, (name, lines)) in enumerate(corpus):
+            if n % 5 == 4:
+                f.write(u'X: %d\n' % (10000 + n))
+            for line in lines:
+                f.write(line + u'\n')
+
+
+def read_file(filename):
+    with io.open(filename, 'rb') as f:
+        return f.read()
+
+
+def convert_to(filename, output, *args, **kwargs):
+    '''Convert the pae file filename with convert_pae_file() to output,
+    and return what was written'''
+    with pae2abc.open_output(output) as out:
+        pae2abc.convert_pae_file(filename, out, *args, **kwargs)
+    return read_file(output)
+
+
+def check_jobs(filename, output, expected, jobs):
+    return convert_to(filename, output, jobs) == expected
+
+
+def check_shards(filename, output, expected, counts):
+    '''Tell whether the shards of filename, one after the other, give
+    the expected output, for each number of shards, with and without
+    the record index'''
+    index = pae2abc.record_index_filename(filename)
+    for indexed in (False, True):
+        if indexed:
+            pae2abc.build_record_index(filename)
+        elif os.path.isfile(index):
+            os.remove(index)
+        for count in counts:
+            result = b''
+            for shard in range(1, count + 1):
+                result += convert_to(filename, output,
+                                     shard=(shard, count))
+            if result != expected:
+                print('%d shards%s give a different output' %
+                      (count, ' with the record index' if indexed else ''),
+                      file=sys.stderr)
+                return False
+    return True
+
+
+def check_checkpoint(filename, output, expected, every, saves):
+    '''Tell whether a checkpointed conversion, interrupted after saves
+    checkpoints with output written after the last one, and then
+    resumed, gives the expected output'''
+    checkpoint = output + '.checkpoint'
+    with pae2abc.open_output(output) as out:
+        try:
+            pae2abc.write_checkpointed_abc(
+                filename, InterruptedCheckpoint(checkpoint, every, saves),
+                out)
+        except Interrupted:
+            # What was converted after the checkpoint, half written
+            out.write('X: 1\nT: lost')
+    with pae2abc.open_output(output, append=True) as out:
+        pae2abc.write_checkpointed_abc(filename,
+                                       pae2abc.Checkpoint(checkpoint, every),
+                                       out, resume=True)
+    return read_file(output) == expected
+
+
+def check_manifest(filename, output, expected, edited, directory):
+    '''Tell whether a conversion with a manifest gives the expected
+    output, the first time and the second, and then for an edited copy
+    of the file what a plain conversion of it gives'''
+    manifest = os.path.join(directory, 'manifest.db')
+    copy = os.path.join(directory, 'copy.pae')
+    shutil.copy(filename, copy)
+    runs = [(expected, 'first'), (expected, 'second')]
+    runs.append((convert_to(edited, output), 'edited'))
+    for (result, name) in runs:
+        if name == 'edited':
+            shutil.copy(edited, copy)
+        with pae2abc.open_output(output) as out:
+            with io.open(copy, encoding='utf-8') as f:
+                pae2abc.write_manifest_abc(pae2abc.read_pae_records(f),
+                                           manifest, out)
+        if read_file(output) != result:
+            print('the %s run with a manifest gives a different output' %
+                  (name), file=sys.stderr)
+            return False
+    return True
+
+
+def edit_corpus(corpus, seed):
+    '''Return a copy of the corpus with some records changed, dropped
+    or added'''
+    rng = random.Random(seed)
+    edited = []
+    for (name, lines) in corpus:
+        choice = rng.random()
+        if choice < 0.05:
+            continue
+        elif choice < 0.10:
+            lines = lines[:-1] + [bench_pae2abc.random_incipit(rng, 4)]
+        elif choice < 0.12:
+            edited.append(('added', bench_pae2abc.random_record(
+                rng, len(edited) + 1, 3)))
+        edited.append((name, lines))
+    return edited
+
+
+def main(args):
+    corpus = bench_pae2abc.generate_corpus(args.seed, args.records)
+    failures = 0
+
+    paes = [lines[-1] for (name, lines) in corpus]
+    (count, failed) = check_incremental(paes, args.seed, args.edits)
+    print('incremental: %d edits, %d wrong' % (count, failed))
+    failures += failed
+
+    directory = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(directory, 'corpus.pae')
+        edited = os.path.join(directory, 'edited.pae')
+        output = os.path.join(directory, 'output.abc')
+        write_corpus(corpus, filename)
+        write_corpus(edit_corpus(corpus, args.seed), edited)
+        expected = convert_to(filename, output)
+        checks = [
+            ('jobs', check_jobs(filename, output, expected, args.jobs)),
+            ('shard', check_shards(filename, output, expected,
+                                   [2, 3, 7])),
+            ('checkpoint', check_checkpoint(filename, output, expected,
+                                            args.records // 10, 4)),
+            ('manifest', check_manifest(filename, output, expected, edited,
+                                        directory)),
+            ]
+    finally:
+        shutil.rmtree(directory)
+    for (name, same) in checks:
+        print('%s: %s' % (name, 'same output' if same else 'DIFFERENT'))
+        if not same:
+            failures += 1
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Check that the faster conversions of pae2abc give '
+        'the same results as the plain one')
+    parser.add_argument('-s', '--seed', type=int, default=1,
+                        help='seed of the synthetic corpus and the edits')
+    parser.add_argument('-n', '--records', type=int, default=2000,
+                        help='number of records of the corpus')
+    parser.add_argument('-e', '--edits', type=int, default=8,
+                        help='random edits of each incipit')
+    parser.add_argument('-j', '--jobs', type=int, default=3,
+                        help='processes of the --jobs check')
+    args = parser.parse_args()
+    sys.exit(main(args))
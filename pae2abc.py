@@ -12,9 +12,31 @@
 
 from __future__ import print_function, division
 
+import io
 import os
 import sys
+import bz2
+import gzip
+import lzma
+import json
+import math
+import mmap
+import stat
+import array
+import heapq
+import bisect
+import locale
+import binascii
+import hashlib
+import sqlite3
+import timeit
 import argparse
+import operator
+import fractions
+import collections
+import itertools
+import multiprocessing
+import xml.etree.ElementTree as ElementTree
 
 # Valid characters for each pae element
 valid_pae_chars = {
@@ -28,6 +50,24 @@ valid_pae_chars = {
     'tune': "CDEFGAB ',0123456789.xbngqr-=/:t+^();{}!fi",
     }
 
+# Pae characters that are a token by themselves, and their kind
+pae_single_tokens = {
+    'b': 'accidental',
+    'x': 'accidental',
+    'n': 'accidental',
+    't': 'trill',
+    '+': 'slur',
+    ')': 'group_end',
+    'i': 'measure_repeat',
+    '{': 'beam_start',
+    '}': 'beam_end',
+    'r': 'grace_end',
+    '-': 'rest',
+    '^': 'chord',
+    }
+for c in valid_pae_chars['notes']:
+    pae_single_tokens[c] = 'note'
+
 # Valid characters for a few abc elements
 valid_abc_chars = {
     'fields': 'XTtBCDFGHIKLMmNOPQRrSsUVWwZ',
@@ -44,29 +84,108 @@ valid_abc_chars = {
     }
 
 
-def clef2abc(pae):
-    '''Translate pae clef to abc'''
-    pae2abc = {
-        # List is short enough, it is easier to be explicit.
-        'C1': 'alto1',
-        'C2': 'alto2',
-        'C3': 'alto3',
-        'C4': 'alto4',
-        'C5': 'alto5',
-        'F1': 'bass1',
-        'F2': 'bass2',
-        'F3': 'bass3',
-        'F4': 'bass4',
-        'F5': 'bass5',
-        'G1': 'treble1',
-        'G2': 'treble2',
-        'G3': 'treble3',
-        'G4': 'treble4',
-        'G5': 'treble5',
-        'c2': 'alto-8',
-        'f2': 'bass-8',
-        'g2': 'treble-8',
-        }
+# Abc clefs of the pae clefs, by shape and line; the notation (- or +)
+# is handled apart.  List is short enough, it is easier to be explicit.
+pae_clefs = {
+    'C1': 'alto1',
+    'C2': 'alto2',
+    'C3': 'alto3',
+    'C4': 'alto4',
+    'C5': 'alto5',
+    'F1': 'bass1',
+    'F2': 'bass2',
+    'F3': 'bass3',
+    'F4': 'bass4',
+    'F5': 'bass5',
+    'G1': 'treble1',
+    'G2': 'treble2',
+    'G3': 'treble3',
+    'G4': 'treble4',
+    'G5': 'treble5',
+    'c2': 'alto-8',
+    'f2': 'bass-8',
+    'g2': 'treble-8',
+    }
+
+# Abc keys of the pae key signatures, by accidental and number of
+# notes
+# TODO: check notes order and maybe choose old modes or explicit notes
+pae_key_signatures = {
+    '':   'C',
+    'x1': 'G',
+    'x2': 'D',
+    'x3': 'A',
+    'x4': 'E',
+    'x5': 'B',
+    'x6': 'F#',
+    'x7': 'C#',
+    'b1': 'F',
+    'b2': 'Bb',
+    'b3': 'Eb',
+    'b4': 'Ab',
+    'b5': 'Db',
+    'b6': 'Gb',
+    'b7': 'Cb',
+    }
+
+# Abc bars of the pae bars; any other one is a single bar
+abc_bars = {
+    '/': '|',
+    '//': '||',
+    '//:': '[|:',
+    '://': ':|]',
+    '://:': '::',
+    }
+
+# Abc lengths of the pae lengths, using abc 1/4 as base; any other one
+# is kept as it is
+# Thanks to http://www.asafraction.co.uk/
+abc_lengths = {
+    '0':    '16',	# longa
+    '9...': '15',
+    '9..':  '14',
+    '9.':   '12',
+    '9':    '8',	# breve
+    '1...': '15/2',
+    '1..':  '7',
+    '1.':   '6',
+    '1':    '4',	# whole note / semibreve (rodona)
+    '2...': '15/4',
+    '2..':  '7/2',
+    '2.':   '3',
+    '2':    '2',	# half-note / minim (blanca)
+    '4...': '15/8',
+    '4..':  '7/4',
+    '4.':   '3/2',
+    '4':    '',	# quarter-note / crochet / semminim (negra)
+    '8...': '15/16',
+    '8..':  '7/8',
+    '8.':   '3/4',
+    '8':    '/2',	# eighth-note / quaver / fusa /
+    '6...': '15/32',
+    '6..':  '7/16',
+    '6.':   '3/8',
+    '6':    '/4',	# 16th-note / semiquaver / semifusa /
+    '3...': '15/64',
+    '3..':  '7/32',
+    '3.':   '3/16',
+    '3':    '/8',	# 32nd-note / demisemiquaver
+    '5...': '15/128',
+    '5..':  '7/64',
+    '5.':   '3/32',
+    '5':    '/16',	# 64th- note / hemidemisemiquaver
+    '7...': '15/256',
+    '7..':  '7/128',
+    '7.':   '3/64',
+    '7':    '/32',	# 128th-note
+    }
+
+# Octaves that a note name can be spelled in
+pae_octaves = frozenset(["'", "''", "'''", "''''", ',', ',,', ',,,'])
+
+
+def spell_clef(pae):
+    '''Work out the abc clef of any pae clef'''
     if len(pae) == 3:
         # Either has the correct length, or it is invalid
         shape = pae[0]
@@ -78,46 +197,91 @@ def clef2abc(pae):
         notation = '-'
         position = '2'
     clef = shape + position
-    if clef in pae2abc:
-        abc = pae2abc[clef]
+    if clef in pae_clefs:
+        abc = pae_clefs[clef]
     else:
-        abc = pae2abc['G2']	# Default
+        abc = pae_clefs['G2']	# Default
     if notation == '+':
         abc += ' stafflines=4'	# Old notation
     return abc
 
 
-def accidentals2abc(pae):
-    '''Translate pae accidentals to abc'''
-    # TODO: check notes order and maybe choose old modes or explicit notes
-    pae2abc = {
-        '':   'C',
-        'x1': 'G',
-        'x2': 'D',
-        'x3': 'A',
-        'x4': 'E',
-        'x5': 'B',
-        'x6': 'F#',
-        'x7': 'C#',
-        'b1': 'F',
-        'b2': 'Bb',
-        'b3': 'Eb',
-        'b4': 'Ab',
-        'b5': 'Db',
-        'b6': 'Gb',
-        'b7': 'Cb',
-        }
+def spell_key_signature(pae):
+    '''Work out the abc key of any pae key signature'''
     if pae:
         pae = pae.replace('[', '').replace(']', '')
         accidental = pae[0]
         notes = pae[1:]
         key = '%s%s' % (accidental, len(notes))
-        if key in pae2abc:
-            abc = pae2abc[key]
+        if key in pae_key_signatures:
+            abc = pae_key_signatures[key]
         else:
-            abc = pae2abc['']
+            abc = pae_key_signatures['']
     else:
-        abc = pae2abc['']
+        abc = pae_key_signatures['']
+    return abc
+
+
+def spell_note(pitch, octave):
+    '''Spell a pae note name in the given pae octave; an unknown octave
+    leaves the note without a name'''
+    if octave == "'":
+        return pitch
+    elif octave == "''":
+        return pitch.lower()
+    elif octave == "'''":
+        return pitch.lower() + "'"
+    elif octave == "''''":
+        return pitch.lower() + "'''"
+    elif octave in [',', ',,', ',,,']:
+        return pitch + octave
+    return ''
+
+
+# The translations of every clef, key signature, bar, length and note
+# that a valid pae incipit can have are worked out here, once, so that
+# converting is mostly looking them up.  They are interned, so that
+# the same abc is always the same string.
+abc_clefs = {}
+for shape in 'CFGcfg':
+    for notation in '-+':
+        for position in '12345':
+            clef = shape + notation + position
+            abc_clefs[clef] = sys.intern(spell_clef(clef))
+
+abc_key_signatures = {'': sys.intern(spell_key_signature(''))}
+for (accidental, order) in [('x', 'FCGDAEB'), ('b', 'BEADGCF')]:
+    for n in range(1, len(order) + 1):
+        for key in ['%s%s' % (accidental, order[:n]),
+                    '%s[%s]' % (accidental, order[:n])]:
+            abc_key_signatures[key] = sys.intern(spell_key_signature(key))
+
+for table in (abc_bars, abc_lengths):
+    for pae in table:
+        table[pae] = sys.intern(table[pae])
+
+# Keyed by abc accidental, pae note name and pae octave
+abc_notes = {}
+for accidental in [''] + list(valid_abc_chars['accidentals']):
+    for pitch in valid_pae_chars['notes']:
+        for octave in pae_octaves:
+            abc_notes[(accidental, pitch, octave)] = sys.intern(
+                accidental + spell_note(pitch, octave))
+
+
+def clef2abc(pae):
+    '''Translate pae clef to abc'''
+    abc = abc_clefs.get(pae)
+    if abc is None:
+        abc = spell_clef(pae)
+    return abc
+
+
+def accidentals2abc(pae):
+    '''Translate pae accidentals to abc'''
+    abc = abc_key_signatures.get(pae)
+    if abc is None:
+        abc = spell_key_signature(pae)
     return abc
 
 
@@ -129,74 +293,331 @@ def timesig2abc(pae):
 
 def bar2abc(pae):
     '''Translate pae bars to abc'''
-    pae2abc = {
-        '/': '|',
-        '//': '||',
-        '//:': '[|:',
-        '://': ':|]',
-        '://:': '::',
-        }
-    if pae in pae2abc:
-        abc = pae2abc[pae]
-    else:
-        abc = pae2abc['/']
-    return abc
+    return abc_bars.get(pae, abc_bars['/'])
 
 
 def notelength2abc(pae):
     '''Translate note lengths bars to abc, using abc 1/4 as base'''
-    # Thanks to http://www.asafraction.co.uk/
-    pae2abc = {
-        '0':    '16',	# longa
-        '9...': '15',
-        '9..':  '14',
-        '9.':   '12',
-        '9':    '8',	# breve
-        '1...': '15/2',
-        '1..':  '7',
-        '1.':   '6',
-        '1':    '4',	# whole note / semibreve (rodona)
-        '2...': '15/4',
-        '2..':  '7/2',
-        '2.':   '3',
-        '2':    '2',	# half-note / minim (blanca)
-        '4...': '15/8',
-        '4..':  '7/4',
-        '4.':   '3/2',
-        '4':    '',	# quarter-note / crochet / semminim (negra)
-        '8...': '15/16',
-        '8..':  '7/8',
-        '8.':   '3/4',
-        '8':    '/2',	# eighth-note / quaver / fusa /
-        '6...': '15/32',
-        '6..':  '7/16',
-        '6.':   '3/8',
-        '6':    '/4',	# 16th-note / semiquaver / semifusa /
-        '3...': '15/64',
-        '3..':  '7/32',
-        '3.':   '3/16',
-        '3':    '/8',	# 32nd-note / demisemiquaver
-        '5...': '15/128',
-        '5..':  '7/64',
-        '5.':   '3/32',
-        '5':    '/16',	# 64th- note / hemidemisemiquaver
-        '7...': '15/256',
-        '7..':  '7/128',
-        '7.':   '3/64',
-        '7':    '/32',	# 128th-note
-        }
-    if pae in pae2abc:
-        abc = pae2abc[pae]
-    else:
-        abc = pae
+    return abc_lengths.get(pae, pae)
+
+
+def scan_run(pae, start, chars):
+    '''Return the position where the run of chars beginning at start
+    ends'''
+    end = start
+    length = len(pae)
+    while end < length and pae[end] in chars:
+        end += 1
+    return end
+
+
+def tokenize_tune(pae, start=0, starts=None):
+    '''Split a pae tune into (kind, value) tokens, moving a cursor
+    forward over the string so that every character is visited once.
+    Tokenizing can begin at start, if that is where a token begins;
+    the position where each token begins is appended to starts, if
+    given.'''
+    length = len(pae)
+    if '(' in pae:
+        # Telling a fermata from an irregular group needs to know how
+        # many notes or rests there are before the closing parenthesis.
+        # Precompute it once for the whole tune instead of looking
+        # ahead each time a ( is found.
+        notes_before = [0]
+        for c in pae:
+            if c in valid_pae_chars['notes'] + '-':
+                notes_before.append(notes_before[-1] + 1)
+            else:
+                notes_before.append(notes_before[-1])
+        next_closing = [length] * (length + 1)
+        for i in range(length - 1, -1, -1):
+            if pae[i] == ')':
+                next_closing[i] = i
+            else:
+                next_closing[i] = next_closing[i+1]
+    position = start
+    while position < length:
+        if starts is not None:
+            starts.append(position)
+        c = pae[position]
+        position += 1
+        kind = pae_single_tokens.get(c)
+        if kind:
+            yield (kind, c)
+        elif c in 'gq':
+            # A doubled g or q starts a group of grace notes
+            value = c
+            if position < length and pae[position] == c:
+                value += c
+                position += 1
+            if c == 'g':
+                yield ('acciaccatura', value)
+            else:
+                yield ('appoggiatura', value)
+        elif c == '(':
+            # Look for notes or rests up to the closing parenthesis,
+            # never including the last character of the tune.
+            end = min(next_closing[position], length - 1)
+            notes = 0
+            if end > position:
+                notes = notes_before[end] - notes_before[position]
+            if notes == 1:
+                yield ('fermata', c)
+            else:
+                yield ('group_start', c)
+        elif c == ';' and position < length and pae[position].isdigit():
+            # Second number of irregular group
+            yield ('group_number', pae[position])
+            position += 1
+        elif c == '!':
+            # Count how many times (how many f) the group has to be
+            # repeated; it only matters for the closing !
+            end = scan_run(pae, position, 'f')
+            yield ('repetition', end - position)
+            position = end
+        elif c in valid_pae_chars['octaves']:
+            end = scan_run(pae, position, valid_pae_chars['octaves'])
+            yield ('octave', pae[position-1:end])
+            position = end
+        elif c in valid_pae_chars['notelength']:
+            end = scan_run(pae, position, valid_pae_chars['notelength'])
+            yield ('length', pae[position-1:end])
+            position = end
+        elif c == '=':
+            end = scan_run(pae, position, '0123456789')
+            yield ('measure_rest', pae[position:end])
+            position = end
+        elif c in valid_pae_chars['bar']:
+            end = scan_run(pae, position, valid_pae_chars['bar'])
+            yield ('bar', pae[position-1:end])
+            position = end
+        else:
+            # Keep them, as the chord logic checks what comes next
+            yield ('ignored', c)
+
+
+class AbcElement(object):
+    '''An element of an abc tune that is kept as its abc text: a bar,
+    a space, an irregular group opening, a chord bracket, a key or
+    meter change, etc.  The prefix holds the marks (trills, slurs) that
+    later pae elements may add in front of it.'''
+
+    __slots__ = ('kind', 'text', 'prefix')
+
+    def __init__(self, kind, text, prefix=''):
+        self.kind = kind
+        self.text = text
+        self.prefix = prefix
+
+    def copy(self):
+        return AbcElement(self.kind, self.text, self.prefix)
+
+    def abc(self):
+        return self.prefix + self.text
+
+
+class AbcNote(object):
+    '''A note or a rest of an abc tune, kept with its pae values (note
+    name, octave and length) until it is written as abc'''
+
+    __slots__ = ('kind', 'pitch', 'octave', 'accidental', 'length',
+                 'grace', 'prefix', 'suffix')
+
+    def __init__(self, kind, pitch='', octave='', accidental='',
+                 length='', grace='', prefix='', suffix=''):
+        self.kind = kind
+        self.pitch = pitch
+        self.octave = octave
+        self.accidental = accidental
+        self.length = length
+        self.grace = grace
+        self.prefix = prefix
+        self.suffix = suffix
+
+    def copy(self):
+        return AbcNote(self.kind, self.pitch, self.octave,
+                       self.accidental, self.length, self.grace,
+                       self.prefix, self.suffix)
+
+    def abc(self):
+        length = abc_lengths.get(self.length, self.length)
+        if self.kind == 'rest':
+            return self.prefix + 'z' + length
+        # An unknown octave leaves the note without a name
+        note = abc_notes.get((self.accidental, self.pitch, self.octave),
+                             self.accidental) + length
+        if self.grace == 'q':
+            note = '{%s}' % (note)
+        elif self.grace == 'qq':
+            # closed by the next r
+            note = '{%s' % (note)
+        elif self.grace == 'g':
+            note = '{/%s}' % (note)
+        elif self.grace == 'gg':
+            # closed by the next r
+            note = '{/%s' % (note)
+        return self.prefix + note + self.suffix
+
+
+# Elements are never changed once in a tune, as repeats share them;
+# they are replaced by a changed copy instead.  So the most common ones
+# can be shared too.
+abc_space = AbcElement('space', ' ')
+
+
+def abc_element_kinds(element):
+    '''Return the kinds of an abc element that parse_tune() may need
+    to find back later: bars (with a |), elements with a (, notes,
+    rests, chord brackets and ! repetition marks'''
+    kinds = []
+    kind = element.kind
+    if kind == 'bar':
+        if '|' in element.text:
+            kinds.append('bar')
+    elif kind == 'group':
+        kinds.append('paren')
+    elif kind == 'note' or kind == 'rest':
+        if '(' in element.prefix:
+            kinds.append('paren')
+        if kind == 'rest':
+            kinds.append('rest')
+        elif element.octave in pae_octaves:
+            # A note may lack its name, if its octave was unknown
+            kinds.append('note')
+    elif kind == 'bracket':
+        kinds.append('bracket')
+    elif kind == 'repetition':
+        kinds.append('repetition')
+    return kinds
+
+
+def elements2abc(elements):
+    '''Write a list of abc elements as an abc string'''
+    abc = ''.join([element.abc() for element in elements])
+    check_abc_length(len(abc))
     return abc
 
 
-def tune2abc(pae, number=''):
-    '''Translate pae tune to abc'''
+# Repeats can make a tune much longer than its pae string: a malformed
+# or hostile one could use up all memory.  Tunes that would grow longer
+# than these are refused instead.
+max_tune_elements = 100000
+max_abc_length = 1000000
+
+
+def set_conversion_limits(elements, length):
+    '''Set how many abc elements a tune may expand to, and how many
+    characters its abc may have'''
+    global max_tune_elements, max_abc_length
+    max_tune_elements = elements
+    max_abc_length = length
+
+
+def check_abc_length(length):
+    '''Refuse an abc tune of length characters if it is too long'''
+    if length > max_abc_length:
+        raise ValueError('the abc tune is %d characters long, more than '
+                         '%d' % (length, max_abc_length))
+
+
+def check_tune_size(size):
+    '''Refuse to expand a tune to size abc elements if it is too many'''
+    if size > max_tune_elements:
+        raise ValueError('repeats expand the tune to %d abc elements, more '
+                         'than %d' % (size, max_tune_elements))
+
+
+class PositionIndex(object):
+    '''Keep the sorted positions of the abc elements of each kind, as
+    parse_tune() adds or changes them, so they can be looked up without
+    rescanning the whole list'''
+
+    def __init__(self):
+        self.positions = {
+            'bar': [],
+            'paren': [],
+            'note': [],
+            'rest': [],
+            'bracket': [],
+            'repetition': [],
+            }
+
+    def append(self, kind, position):
+        '''Remember that the element just appended at position is of
+        kind'''
+        self.positions[kind].append(position)
+
+    def add(self, position, element):
+        '''Remember element, that is now at position'''
+        for kind in abc_element_kinds(element):
+            positions = self.positions[kind]
+            if not positions or positions[-1] < position:
+                # Most of the time elements are appended at the end
+                positions.append(position)
+            else:
+                bisect.insort(positions, position)
+
+    def remove(self, position, element):
+        '''Forget element, that was at position'''
+        for kind in abc_element_kinds(element):
+            positions = self.positions[kind]
+            i = bisect.bisect_left(positions, position)
+            if i < len(positions) and positions[i] == position:
+                del positions[i]
+
+    def shift(self, start, delta):
+        '''Move by delta all positions from start on, as when an
+        element is inserted or deleted'''
+        for positions in self.positions.values():
+            i = bisect.bisect_left(positions, start)
+            for j in range(i, len(positions)):
+                positions[j] += delta
+
+    def repeat(self, start, end, offset, times):
+        '''Add the positions of the elements in [start:end], copied
+        times times from offset on'''
+        size = end - start
+        for positions in self.positions.values():
+            i = bisect.bisect_left(positions, start)
+            j = bisect.bisect_left(positions, end)
+            copied = positions[i:j]
+            for n in range(times):
+                delta = offset - start + n * size
+                positions.extend([p + delta for p in copied])
+
+    def last(self, kind, end=None):
+        '''Return the last position of kind before end, or -1'''
+        positions = self.positions[kind]
+        if end is None:
+            i = len(positions)
+        else:
+            i = bisect.bisect_left(positions, end)
+        if i:
+            return positions[i-1]
+        return -1
+
+    def copy(self):
+        index = PositionIndex()
+        for kind in self.positions:
+            index.positions[kind] = self.positions[kind][:]
+        return index
+
+    def first(self, kind):
+        '''Return the first position of kind, or -1'''
+        positions = self.positions[kind]
+        if positions:
+            return positions[0]
+        return -1
+
+
+def parse_tune(pae, number='', snapshots=None, resume=None):
+    '''Parse a pae tune into a list of abc elements.  If snapshots is a
+    list, the state of the parser at the start of the tune and of some
+    measures is appended to it, as a dict; parsing can be resumed from
+    one of them, with resume, for a tune that is the same up to there.'''
 
     # Set some defaults
-    note = ''
+    accidental = ''
     octave = "'"
     slur = False
     trill = False
@@ -208,161 +629,198 @@ def tune2abc(pae, number=''):
     rhythmic_backup = False
     irregular_group = False
 
-    # Input and output structures are lists.
-    pae_list = list(pae)
-    abc_list = []
-    while pae_list:
-        # Main loop parser. Get next pae character and convert it to abc
-        c = pae_list.pop(0)
-        if c == 'b':
-            # flatten
-            note = '_'
-        elif c == 'x':
-            # sharpen
-            note = '^'
-        elif c == 'n':
-            # naturalise
-            note = '='
-        elif c == 't':
+    # Input is a list of tokens, output a list of abc elements.  Some
+    # constructs need to go back to previous abc elements; keep an
+    # index of where they are.
+    elements = []
+    index = PositionIndex()
+    start = 0
+    if resume is not None:
+        (number, accidental, octave, slur, trill, chord, beaming,
+         acciaccatura, appoggiatura, rhythmic_model, rhythmic_backup,
+         irregular_group) = resume['state']
+        # The rhythmic model is used up as it goes
+        rhythmic_model = rhythmic_model and rhythmic_model[:]
+        elements = resume['elements'][:]
+        index = resume['index'].copy()
+        start = resume['position']
+    starts = None
+    if snapshots is not None:
+        starts = []
+    tokens = list(tokenize_tune(pae, start, starts))
+    # Tokens are followed by an empty one, to look ahead at the end.
+    tokens.append(('', ''))
+    if snapshots is not None:
+        # Keeping a copy of the elements at every measure would take
+        # quadratic memory for long tunes, so keep about 32 at most
+        snapshot_gap = len(tokens) // 32
+        snapshot_size = len(elements)
+        if resume is None:
+            snapshots.append({
+                'position': 0,
+                'elements': [],
+                'index': PositionIndex(),
+                'state': (number, accidental, octave, slur, trill, chord,
+                          beaming, acciaccatura, appoggiatura,
+                          rhythmic_model, rhythmic_backup, irregular_group),
+                'safe': True,
+                })
+    for (position, (kind, value)) in enumerate(tokens):
+        # Main loop parser. Get next pae token and convert it to abc
+        if kind == 'accidental':
+            if value == 'b':
+                # flatten
+                accidental = '_'
+            elif value == 'x':
+                # sharpen
+                accidental = '^'
+            elif value == 'n':
+                # naturalise
+                accidental = '='
+        elif kind == 'trill':
             # trill
-            trill = c
-        elif c == '+':
+            trill = value
+        elif kind == 'slur':
             # slur
-            slur = c
-        elif c == 'g':
+            slur = value
+        elif kind == 'acciaccatura':
             # acciacciatura
-            acciaccatura = c
-            if pae_list and pae_list[0] == c:
-                acciaccatura += pae_list.pop(0)
+            acciaccatura = value
+            if len(value) > 1:
                 beaming = True
-        elif c == 'q':
+        elif kind == 'appoggiatura':
             # appoggiatura
-            appoggiatura = c
-            if pae_list and pae_list[0] == c:
-                appoggiatura += pae_list.pop(0)
+            appoggiatura = value
+            if len(value) > 1:
                 beaming = True
-        elif c == '(':
-            # This can be either a fermata (includes only one note or
-            # rest; accidentals or octave symbols must be outside the
-            # parentheses) or an irregular rhythmic group.
-            i = 0
-            notes = ''
-            while pae_list and pae_list[i] != ')' and i < len(pae_list)-1:
-                if pae_list[i] in valid_pae_chars['notes'] + '-':
-                    notes += pae_list[i]
-                i += 1
-            if len(notes) == 1:
-                # Single note or silence: fermata
-                abc_list.append('H')
-            else:
-                if not number:
-                    number = '8'
-                irregular_group = number
-                abc_list.append('(') # Remember the position where it starts
-        elif c == ';':
-            # Second number of irregular group
-            if pae_list and pae_list[0].isdigit():
-                number = pae_list.pop(0)
-                # In ABC the order of the numbers is reversed
-                irregular_group = '%s:%s' % (number, irregular_group)
-        elif c == ')':
+        elif kind == 'fermata':
+            # Single note or silence inside parentheses (accidentals or
+            # octave symbols must be outside them)
+            elements.append(AbcElement('fermata', 'H'))
+        elif kind == 'group_start':
+            # Irregular rhythmic group
+            if not number:
+                number = '8'
+            irregular_group = number
+            index.append('paren', len(elements))
+            # Remember the position where it starts
+            elements.append(AbcElement('group', '('))
+        elif kind == 'group_number':
+            number = value
+            # In ABC the order of the numbers is reversed
+            irregular_group = '%s:%s' % (number, irregular_group)
+        elif kind == 'group_end':
             if irregular_group:
                 # close irregular group
                 if len(irregular_group) == 1:
                     irregular_group = '3'
                 # Look for ( to add the pair of p:q numbers
-                found = [i for i in range(len(abc_list)) if '(' in abc_list[i]]
-                if found:
-                    i = found[-1]
-                    abc_list[i] = '(%s' % (irregular_group)
+                i = index.last('paren')
+                if i >= 0:
+                    group = '(%s' % (irregular_group)
                     if not beaming:
-                        abc_list[i] += ' '
+                        group += ' '
+                    index.remove(i, elements[i])
+                    elements[i] = AbcElement('group', group)
+                    index.add(i, elements[i])
                 irregular_group = ''
                 number = '' # Needed?
-        elif c == 'i':
+        elif kind == 'measure_repeat':
             # Repeat last measure
-            # Fist, find where bar signs are
-            found = [i for i in range(len(abc_list)) if '|' in abc_list[i]]
+            # Fist, find where the last two bar signs are
+            found = index.positions['bar'][-2:]
             if len(found) == 1:
                 # If there was a single bar sign, add a -2 (that will
                 # become a zero later) as first position.
                 found.insert(0, -2)
             # Extract last measure values, excluding bar signs,
             # because they are handled by the /i/ syntax anyway.
-            last_measure = abc_list[found[-2]+2:found[-1]]
-            abc_list.extend(last_measure)
-        elif c == '!':
+            start = found[-2] + 2
+            end = found[-1]
+            check_tune_size(len(elements) + end - start)
+            index.repeat(start, end, len(elements), 1)
+            elements.extend(elements[start:end])
+        elif kind == 'repetition':
             # Repetition of notes
-            if c in abc_list:
+            found = index.first('repetition')
+            if found >= 0:
                 # A previous ! marks the start position of the group
                 # to repeat
-                found = abc_list.index(c)
-                abc_list.remove(c)
-                # Count how many times (how many f) has to be repeated
-                n = 0
-                while pae_list and pae_list[0] == 'f':
-                    pae_list.pop(0)
-                    n += 1
-                repeat = abc_list[found:] * n
-                abc_list.extend(repeat)
+                check_tune_size(len(elements) - 1 +
+                                (len(elements) - 1 - found) * value)
+                index.remove(found, elements[found])
+                index.shift(found, -1)
+                del elements[found]
+                # Repeat as many times as f were found
+                index.repeat(found, len(elements), len(elements), value)
+                repeat = elements[found:] * value
+                elements.extend(repeat)
             else:
-                abc_list.append(c)
-        elif c == '{':
+                index.append('repetition', len(elements))
+                elements.append(AbcElement('repetition', '!'))
+        elif kind == 'beam_start':
             beaming = True
-        elif c == '}':
-            abc_list.append(' ')
+        elif kind == 'beam_end':
+            elements.append(abc_space)
             beaming = False
-        elif c == 'r':
-            abc_list.append('}')
+        elif kind == 'grace_end':
+            elements.append(AbcElement('grace_end', '}'))
             beaming = False
-        elif c in valid_pae_chars['octaves']:
+        elif kind == 'octave':
             # octave
-            octave = c
-            while pae_list and pae_list[0] in valid_pae_chars['octaves']:
-                octave += pae_list.pop(0)
-        elif c in valid_pae_chars['notelength']:
+            octave = value
+        elif kind == 'length':
             # note length
-            number = c
-            while pae_list and pae_list[0] in valid_pae_chars['notelength']:
-                number += pae_list.pop(0)
-            if pae_list and '(' in pae_list[0]:
+            number = value
+            if tokens[position+1][0] in ('fermata', 'group_start'):
                 irregular_group = number
-        elif c == '=':
+        elif kind == 'measure_rest':
             # measure rest
-            number = ''
-            while pae_list and pae_list[0].isdigit():
-                number += pae_list.pop(0)
+            number = value
             if number == '1':
                 number = ''
-            abc_list.append('Z' + number)
-            abc_list.append(' ')
+            elements.append(AbcElement('measure_rest', 'Z' + number))
+            elements.append(abc_space)
             number = ''
-        elif c == '-':
+        elif kind == 'rest':
             # note rest
-            abc_list.append('z' + notelength2abc(number))
-            abc_list.append(' ')
-        elif c == '^':
+            index.append('rest', len(elements))
+            elements.append(AbcNote('rest', length=number))
+            elements.append(abc_space)
+        elif kind == 'chord':
             # Chord
-            chord = c
-        elif c in valid_pae_chars['bar']:
+            chord = value
+        elif kind == 'bar':
             # bar
-            bar = c
-            while pae_list and pae_list[0] in valid_pae_chars['bar']:
-                bar += pae_list.pop(0)
-            abc_list.append(bar2abc(bar))
-            abc_list.append(' ')
-        elif c in valid_pae_chars['notes']:
+            bar = abc_bars.get(value, '|')
+            if '|' in bar:
+                index.append('bar', len(elements))
+            elements.append(AbcElement('bar', bar))
+            elements.append(abc_space)
+            if snapshots is not None and \
+               len(elements) >= snapshot_size + snapshot_gap:
+                # The state at the start of the next measure
+                snapshot_size = len(elements)
+                if position + 1 < len(starts):
+                    next_start = starts[position + 1]
+                else:
+                    next_start = len(pae)
+                snapshots.append({
+                    'position': next_start,
+                    'elements': elements[:],
+                    'index': index.copy(),
+                    'state': (number, accidental, octave, slur, trill, chord,
+                              beaming, acciaccatura, appoggiatura,
+                              rhythmic_model and rhythmic_model[:],
+                              rhythmic_backup, irregular_group),
+                    # Whether a ( is a fermata depends on what comes
+                    # up to the next ), so it must not come after
+                    'safe': (pae.rfind('(', 0, next_start) <=
+                             pae.rfind(')', 0, next_start)),
+                    })
+        elif kind == 'note':
             # notes
-            if octave == "'":
-                note += c
-            elif octave == "''":
-                note += c.lower()
-            elif octave == "'''":
-                note += c.lower() + "'"
-            elif octave == "''''":
-                note += c.lower() + "'''"
-            elif octave in [',', ',,', ',,,']:
-                note += c + octave
+            note = AbcNote('note', value, octave, accidental)
             if number:
                 if number.startswith('.'):
                     # That's a syntax error, ignore
@@ -384,158 +842,288 @@ def tune2abc(pae, number=''):
                     # as we will consume the working copy as we use it.
                     rhythmic_backup = rhythmic_model[:]
                     number = ''
-                    note += notelength2abc(rhythmic_model.pop(0))
+                    note.length = rhythmic_model.pop(0)
                 else:
-                    note += notelength2abc(number)
+                    note.length = number
             elif rhythmic_model or rhythmic_backup:
                 if not rhythmic_model:
                     # Model exhausted; start anew
                     rhythmic_model = rhythmic_backup[:]
-                note += notelength2abc(rhythmic_model.pop(0))
+                note.length = rhythmic_model.pop(0)
             if appoggiatura:
-                if len(appoggiatura) == 1:
-                    note = '{%s}' % (note)
-                else:
-                    # closed by the next r
-                    note = '{%s' % (note)
+                # A single q is closed right away, qq by the next r
+                note.grace = appoggiatura
                 appoggiatura = False
             elif acciaccatura:
-                if len(acciaccatura) == 1:
-                    note = '{/%s}' % (note)
-                else:
-                    # closed by the next r
-                    note = '{/%s' % (note)
+                # A single g is closed right away, gg by the next r
+                note.grace = acciaccatura
                 acciaccatura = False
             elif slur or trill or chord:
                 # All share the same logic; handle them together.
                 # Look for most recent note or silence (for slur only)
-                valid_chars = valid_abc_chars['notes']
+                i = index.last('note')
                 if slur:
-                    valid_chars +=  'z'
-                i = len(abc_list) - 1
-                while i >= 0:
-                    found = [True for c in abc_list[i]
-                             if c in valid_chars]
-                    if found:
-                        break
-                    else:
-                        i -= 1
+                    i = max(i, index.last('rest'))
                 if i >= 0:
-                    if trill:
-                        abc_list[i] = 'T%s' % (abc_list[i])
-                        trill = False
-                    if slur:
-                        abc_list[i] = '(%s' % (abc_list[i])
-                        note += ')'
-                        slur = False
+                    if trill or slur:
+                        previous = elements[i].copy()
+                        index.remove(i, elements[i])
+                        if trill:
+                            previous.prefix = 'T' + previous.prefix
+                            trill = False
+                        if slur:
+                            previous.prefix = '(' + previous.prefix
+                            note.suffix = ')'
+                            slur = False
+                        elements[i] = previous
+                        index.add(i, previous)
                     if chord:
                         # Leave notes only, remove spaces
-                        while abc_list and abc_list[-1] == ' ':
-                            abc_list.pop()
+                        while elements and elements[-1].kind == 'space':
+                            elements.pop()
                         # Check whether the chord is already opened
                         open_chord = True
-                        j = i
-                        while j >= 0:
-                            if abc_list[j] == '[':
-                                # Found a 2 or more notes chord
-                                open_chord = False
-                                break
-                            elif abc_list[j] == ']':
-                                break
-                            j -= 1
+                        j = index.last('bracket', i + 1)
+                        if j >= 0 and elements[j].text == '[':
+                            # Found a 2 or more notes chord
+                            open_chord = False
                         if open_chord:
-                            abc_list.insert(i, '[')
-                            if pae_list:
-                                if pae_list[0] == '^':
+                            # Only what came after the last note needs
+                            # to be shifted
+                            bracket = AbcElement('bracket', '[')
+                            index.shift(i, 1)
+                            index.add(i, bracket)
+                            elements.insert(i, bracket)
+                            next_kind = tokens[position+1][0]
+                            if next_kind:
+                                if next_kind == 'chord':
                                     chord = ''
                                 else:
                                     chord = ']'
                         else:
                             chord = ']'
-            abc_list.append(note)
-            note = ''
+            if octave in pae_octaves:
+                # An unknown octave leaves the note without a name
+                index.append('note', len(elements))
+            elements.append(note)
+            accidental = ''
             if chord == ']':
-                abc_list.append(chord)
+                index.append('bracket', len(elements))
+                elements.append(AbcElement('bracket', chord))
                 chord = ''
             if not beaming:
-                abc_list.append(' ')
-    abc = ''.join(abc_list)
-    return (abc, number)
+                elements.append(abc_space)
+    return (elements, number)
 
 
-def pae2abc(pae, fields={}):
-    '''Main converter funcion; split the pae string into header and
-    body, and convert them'''
+def tune2abc(pae, number=''):
+    '''Translate pae tune to abc'''
+    (elements, number) = parse_tune(pae, number)
+    return (elements2abc(elements), number)
 
-    # Destination structure
-    abc = {
-        'header': {
-            'clef': '',
-            'accidentals': '',
-            'timesig': '',
-            },
-        'body': {
-            'tune': '',
-            }
+
+def parse_pae(pae, snapshots=None, resume=None):
+    '''Split the pae string into header and body, and parse them.
+    Return the header abc values and the list of abc elements of the
+    tune, where later clef, key or meter changes are elements too.
+    With a list of snapshots, the states of parse_tune() are appended
+    to it, with what it needs to resume parsing the pae string from
+    them too.'''
+
+    header = {
+        'clef': '',
+        'accidentals': '',
+        'timesig': '',
         }
+    elements = []
 
-    # Add pseudo-abc fields
-    if not 'X' in fields:
-        abc['header']['X'] = 1
-    for field in fields:
-        abc['header'][field] = fields[field]
     number = ''
 
     # Split the pae string in header (clef, accidentals and time
-    # signature) and body, looping one char at a time.
-    pae_list = list(pae)
-    while pae_list:
-        c = pae_list.pop(0)
+    # signature) and body, moving a cursor along it.
+    position = 0
+    if resume is not None:
+        # Go back to the space before the tune to resume
+        header = dict(resume['header'])
+        elements = resume['before'][:]
+        position = resume['tune'] - 1
+    while position < len(pae):
+        c = pae[position]
+        position += 1
         if c == '%':
-            value = ''
-            while pae_list and pae_list[0] in valid_pae_chars['clef']:
-                value += pae_list.pop(0)
-            if not abc['header']['clef']:
-                abc['header']['clef'] = clef2abc(value)
+            end = scan_run(pae, position, valid_pae_chars['clef'])
+            value = pae[position:end]
+            position = end
+            if not header['clef']:
+                header['clef'] = clef2abc(value)
             else:
-                abc['body']['tune'] += '[K: %s] ' % (clef2abc(value))
+                elements.append(AbcElement('clef', '[K: %s] ' % (clef2abc(value))))
         elif c == '$':
-            value = ''
-            while pae_list and pae_list[0] in valid_pae_chars['accidentals']:
-                value += pae_list.pop(0)
-            if not abc['header']['accidentals']:
-                abc['header']['accidentals'] = accidentals2abc(value)
+            end = scan_run(pae, position, valid_pae_chars['accidentals'])
+            value = pae[position:end]
+            position = end
+            if not header['accidentals']:
+                header['accidentals'] = accidentals2abc(value)
             else:
-                abc['body']['tune'] += '[K: %s] ' % (accidentals2abc(value))
+                elements.append(AbcElement('key', '[K: %s] ' % (accidentals2abc(value))))
         elif c == '@':
-            value = ''
-            while pae_list and pae_list[0] in valid_pae_chars['timesig']:
-                value += pae_list.pop(0)
-            if not abc['header']['timesig']:
-                abc['header']['timesig'] = timesig2abc(value)
+            end = scan_run(pae, position, valid_pae_chars['timesig'])
+            value = pae[position:end]
+            position = end
+            if not header['timesig']:
+                header['timesig'] = timesig2abc(value)
             else:
-                abc['body']['tune'] += '[M: %s] ' % (timesig2abc(value))
+                elements.append(AbcElement('meter', '[M: %s] ' % (timesig2abc(value))))
         elif c == ' ':
-            value = ''
-            while pae_list and pae_list[0] in valid_pae_chars['tune']:
-                value += pae_list.pop(0)
-            (tune, number) = tune2abc(value, number)
-            abc['body']['tune'] += tune
+            end = scan_run(pae, position, valid_pae_chars['tune'])
+            value = pae[position:end]
+            tune_snapshots = None
+            if snapshots is not None:
+                tune_snapshots = []
+            (tune, number) = parse_tune(value, number, tune_snapshots,
+                                        resume)
+            resume = None
+            if snapshots is not None:
+                before = elements[:]
+                tune_header = dict(header)
+                for snapshot in tune_snapshots:
+                    snapshot['tune'] = position
+                    snapshot['before'] = before
+                    snapshot['header'] = tune_header
+                snapshots.extend(tune_snapshots)
+            position = end
+            check_tune_size(len(elements) + len(tune))
+            elements.extend(tune)
+
+    return (header, elements)
+
+
+def convert_pae(pae):
+    '''Split the pae string into header and body, and convert them.
+    Return the abc structure, still without information fields.'''
+    (header, elements) = parse_pae(pae)
+    return {
+        'header': header,
+        'body': {
+            'tune': elements2abc(elements),
+            }
+        }
+
+
+class IncrementalConversion(object):
+    '''The conversion of a pae string that is being edited, as in a
+    live preview.  The state of the parser is kept at the start of
+    every tune (that is, after every clef, key or meter change) and of
+    measures, so that after an edit only what comes from the last of
+    them before the edit is parsed again, and only the abc of the
+    elements that changed is written again.'''
+
+    def __init__(self, pae, previous=None, resume=None, snapshots=None):
+        self.pae = pae
+        self.snapshots = []
+        if snapshots is not None:
+            self.snapshots = snapshots
+        (self.header, self.elements) = parse_pae(pae, self.snapshots,
+                                                 resume)
+        # Only reuse the abc of a previous conversion already written
+        self.previous = None
+        if previous is not None and previous.abc is not None:
+            self.previous = previous
+        self.abc = None
+        self.offsets = None
+
+    def edit(self, offset, deleted, inserted):
+        '''Return the conversion of the pae string with the deleted
+        characters from offset on replaced by the inserted string'''
+        if offset < 0 or deleted < 0 or offset + deleted > len(self.pae):
+            raise ValueError('the edit is out of the pae string')
+        pae = self.pae[:offset] + inserted + self.pae[offset + deleted:]
+        for i in range(len(self.snapshots) - 1, -1, -1):
+            snapshot = self.snapshots[i]
+            position = snapshot['tune'] + snapshot['position']
+            if position > offset or not snapshot['safe']:
+                continue
+            if snapshot['position'] and position < len(pae) and \
+               pae[position] in valid_pae_chars['bar']:
+                # The bar before would be a different one
+                continue
+            return IncrementalConversion(pae, self, snapshot,
+                                         self.snapshots[:i + 1])
+        return IncrementalConversion(pae, self)
+
+    def tune(self):
+        '''Return the abc tune, reusing the abc of the elements that
+        the previous conversion shares from the start'''
+        if self.abc is None:
+            start = 0
+            offsets = [0]
+            prefix = ''
+            if self.previous is not None:
+                previous = self.previous
+                size = min(len(self.elements), len(previous.elements))
+                while start < size and \
+                      self.elements[start] is previous.elements[start]:
+                    start += 1
+                offsets = previous.offsets[:start + 1]
+                prefix = previous.abc[:offsets[-1]]
+                self.previous = None
+            texts = [element.abc() for element in self.elements[start:]]
+            for text in texts:
+                offsets.append(offsets[-1] + len(text))
+            check_abc_length(offsets[-1])
+            self.abc = prefix + ''.join(texts)
+            self.offsets = offsets
+        return self.abc
+
+    def convert(self):
+        '''Return the abc structure, as convert_pae() does'''
+        return {
+            'header': self.header,
+            'body': {
+                'tune': self.tune(),
+                }
+            }
+
+    def diff(self, previous):
+        '''Return how the abc tune changed from a previous conversion,
+        as an (offset, deleted, inserted) edit'''
+        old = previous.tune()
+        new = self.tune()
+        size = min(len(old), len(new))
+        start = 0
+        while start < size and old[start] == new[start]:
+            start += 1
+        end = 0
+        while end < size - start and old[-1 - end] == new[-1 - end]:
+            end += 1
+        return (start, len(old) - start - end, new[start:len(new) - end])
+
+
+def abc_stanza(pae, abc, fields={}, debug=False):
+    '''Build an abc stanza from the abc structure of a converted pae
+    string, adding the information fields'''
+
+    # Add pseudo-abc fields
+    header = dict(abc['header'])
+    if not 'X' in fields:
+        header['X'] = 1
+    for field in fields:
+        header[field] = fields[field]
 
     # Build a proper abc stanza, filling only those available fields
     out = []
     for field in valid_abc_chars['header_fields']:
-        if field in abc['header']:
-            out.append('%s: %s' % (field, abc['header'][field]))
+        if field in header:
+            out.append('%s: %s' % (field, header[field]))
     out.append('L: 1/4')
-    out.append('M: %s' % (abc['header']['timesig']))
-    out.append('K: %s %s' % (abc['header']['accidentals'],
-                             abc['header']['clef']))
+    out.append('M: %s' % (header['timesig']))
+    out.append('K: %s %s' % (header['accidentals'],
+                             header['clef']))
     out.append('%s' % (abc['body']['tune']))
     for field in valid_abc_chars['body_fields']:
-        if field in abc['header']:
-            out.append('%s: %s' % (field, abc['header'][field]))
-    if args.debug:
+        if field in header:
+            out.append('%s: %s' % (field, header[field]))
+    if debug:
         # TODO: change to new syntax (stylesheet?)
         out.append('%%writefields N true')
         out.append('%%annotationfont Courier 11')
@@ -546,57 +1134,2389 @@ def pae2abc(pae, fields={}):
     return '\n'.join(out)
 
 
-def convert_pae_file(filename):
-    '''Convert a file with PAE entries, with optional ABC fields'''
+def pae2abc(pae, fields={}, debug=False):
+    '''Main converter funcion; split the pae string into header and
+    body, and convert them'''
+    return abc_stanza(pae, convert_pae(pae), fields, debug)
+
+
+# Deleting the valid characters of a tune with str.translate() leaves
+# only those that the converter would skip
+tune_deletions = dict.fromkeys([ord(c) for c in valid_pae_chars['tune']])
+
+# Pae characters that need a note after them
+pae_note_modifiers = "xbn',tgq+^"
+
+
+def find_all(pae, chars, start, end):
+    '''Return the positions of chars in pae, between start and end'''
+    positions = []
+    i = pae.find(chars, start, end)
+    while i >= 0:
+        positions.append(i)
+        i = pae.find(chars, i + 1, end)
+    return positions
+
+
+def valid_clef(value):
+    '''Tell whether value is a clef that clef2abc() knows'''
+    if len(value) != 3 or value[1] not in '+-':
+        return False
+    if value[0] in 'CFG':
+        return value[2] in '12345'
+    return value[0] in 'cfg' and value[2] == '2'
+
+
+def valid_key_signature(value):
+    '''Tell whether value is a key signature, such as xFCG or bBE,
+    with its notes in the order that accidentals2abc() expects'''
+    if not value:
+        return True
+    notes = value[1:].replace('[', '').replace(']', '')
+    if value[0] == 'x':
+        return 'FCGDAEB'.startswith(notes)
+    elif value[0] == 'b':
+        return 'BEADGCF'.startswith(notes)
+    return False
+
+
+def valid_time_signature(value):
+    '''Tell whether value is a time signature, such as 3/4, c, c/, o
+    or c3/2, or none at all'''
+    if value in ('', 'c', 'c/', 'o', 'o.'):
+        return True
+    if value[:1] in ('c', 'o'):
+        value = value[1:]
+    numbers = value.split('/')
+    if len(numbers) > 2:
+        return False
+    for number in numbers:
+        if not number.isdigit():
+            return False
+    return True
+
+
+def validate_tune(pae, start, end, errors):
+    '''Check the tune of pae between start and end, appending
+    (kind, offset) tuples to errors for what the converter would
+    ignore, guess or fail on'''
+
+    for i in find_all(pae, '.', start, end):
+        # A dot must follow a length
+        if i == start or pae[i-1] not in valid_pae_chars['notelength']:
+            errors.append(('dot_without_length', i))
+
+    for (opening, closing, name) in (('(', ')', 'parenthesis'),
+                                     ('{', '}', 'beam')):
+        unclosed = []
+        for i in sorted(find_all(pae, opening, start, end) +
+                        find_all(pae, closing, start, end)):
+            if pae[i] == opening:
+                unclosed.append(i)
+            elif unclosed:
+                unclosed.pop()
+            else:
+                errors.append(('unmatched_%s' % (name), i))
+        for i in unclosed:
+            errors.append(('unclosed_%s' % (name), i))
+
+    repetitions = find_all(pae, '!', start, end)
+    if len(repetitions) % 2:
+        errors.append(('unclosed_repetition', repetitions[-1]))
+    for i in find_all(pae, 'f', start, end):
+        if pae[i-1] not in '!f':
+            errors.append(('f_without_repetition', i))
+
+    grace_groups = sorted(find_all(pae, 'qq', start, end) +
+                          find_all(pae, 'gg', start, end) +
+                          find_all(pae, 'r', start, end))
+    unclosed = []
+    for i in grace_groups:
+        if pae[i] != 'r':
+            unclosed.append(i)
+        elif unclosed:
+            unclosed.pop()
+        else:
+            errors.append(('unmatched_grace_end', i))
+    for i in unclosed:
+        errors.append(('unclosed_grace_notes', i))
+
+    measure_repeats = find_all(pae, 'i', start, end)
+    if measure_repeats:
+        # Bars that are found back, all but ://: that has no |
+        bars = []
+        for i in find_all(pae, '/', start, end):
+            bar_start = i
+            while bar_start > start and pae[bar_start-1] in ':/':
+                bar_start -= 1
+            bar_end = scan_run(pae, i, ':/')
+            if pae[bar_start:bar_end] != '://:':
+                bars.append(i)
+        for i in measure_repeats:
+            if not bars or bars[0] > i:
+                errors.append(('measure_repeat_without_bar', i))
+
+    for i in find_all(pae, ';', start, end):
+        if i + 1 >= end or not pae[i+1].isdigit():
+            errors.append(('bad_group_number', i))
+
+    for i in find_all(pae, '^', start, end):
+        if i == start or pae[i-1] not in valid_pae_chars['notes']:
+            errors.append(('misplaced_chord', i))
+
+    if end > start:
+        # The tune must not end halfway through a note
+        i = end - 1
+        if pae[i] in pae_note_modifiers:
+            errors.append(('incomplete_note', i))
+        elif pae[i] in valid_pae_chars['notelength']:
+            while i > start and pae[i-1] in valid_pae_chars['notelength']:
+                i -= 1
+            if i == start or pae[i-1] != '=':
+                errors.append(('incomplete_note', i))
+
+
+def validate_pae(pae):
+    '''Check pae against the grammar that the converter expects,
+    without converting it.  Return a list of (kind, offset) errors,
+    sorted by offset, counted from 0 in the pae string; an empty list
+    if it is valid.'''
+
+    errors = []
+    if not pae.startswith('%'):
+        errors.append(('missing_clef', 0))
+    tune_start = pae.find(' ')
+    if tune_start < 0:
+        errors.append(('missing_tune', len(pae)))
+        tune_start = len(pae)
+
+    # Most records are a header and a tune with valid characters only,
+    # so look for header items and skipped characters one at a time
+    # only if there are some after the header.
+    position = 0
+    end = tune_start
+    if pae[tune_start+1:].translate(tune_deletions):
+        end = len(pae)
+    while position < end:
+        c = pae[position]
+        position += 1
+        if c == '%':
+            value_end = scan_run(pae, position, valid_pae_chars['clef'])
+            if not valid_clef(pae[position:value_end]):
+                errors.append(('bad_clef', position))
+            position = value_end
+        elif c == '$':
+            value_end = scan_run(pae, position,
+                                 valid_pae_chars['accidentals'])
+            if not valid_key_signature(pae[position:value_end]):
+                errors.append(('bad_key_signature', position))
+            position = value_end
+        elif c == '@':
+            value_end = scan_run(pae, position, valid_pae_chars['timesig'])
+            if not valid_time_signature(pae[position:value_end]):
+                errors.append(('bad_time_signature', position))
+            position = value_end
+        elif c == ' ':
+            tune_end = scan_run(pae, position, valid_pae_chars['tune'])
+            validate_tune(pae, position, tune_end, errors)
+            position = tune_end
+        else:
+            errors.append(('invalid_char', position - 1))
+    if end < len(pae):
+        # A single tune, up to the end
+        validate_tune(pae, tune_start + 1, len(pae), errors)
+    errors.sort(key=lambda error: error[1])
+    return errors
+
+
+def validate_records(records, out=None):
+    '''Validate (pae, fields) records, and write a JSON line to out,
+    standard output by default, for each one with errors.  Return the
+    number of records and of invalid ones.'''
+
+    if out is None:
+        out = sys.stdout
+    count = 0
+    invalid = 0
+    for (count, (pae, fields)) in enumerate(records, 1):
+        errors = validate_pae(pae)
+        if errors:
+            invalid += 1
+            report = {
+                'record': count,
+                # Automatic X numbers are ints, given ones strings
+                'fields': dict([(field, str(fields[field]))
+                                for field in 'XP' if field in fields]),
+                'pae': pae,
+                'errors': [{'kind': kind,
+                            'offset': offset,
+                            'char': pae[offset:offset+1]}
+                           for (kind, offset) in errors],
+                }
+            out.write(json.dumps(report))
+            out.write('\n')
+    return (count, invalid)
+
+
+def read_pae_records(f, n=0):
+    '''Read a file with PAE entries, with optional ABC fields, and
+    yield a (pae, fields) pair for each entry, in file order.  Entries
+    without X field are numbered after the n previous ones.'''
 
-    print('%abc-2.1\n')
-    n = 0
     pae = ''
     fields = {}
-    with open(filename) as f:
-        for line in f:
-            line = line.strip()
-            if len(line) > 2:
-                if line[0] in valid_abc_chars['fields'] and line[1] == ':':
-                    key = line[0]
-                    value = line[2:].strip()
-                    fields[key] = value
-                elif line[0] == '@' and ':' in line:
-                    # Verovio PAE file format
-                    key, value = line.split(':', 1)
-                    if key == '@clef':
-                        pae += '%%%s' % (value)
-                    elif key == '@keysig':
-                        pae += '$%s' % (value)
-                    elif key == '@timesig':
-                        pae += '@%s' % (value)
-                    elif key == '@data':
-                        pae += ' %s' % (value)
-                        abc = pae2abc(pae, {})
-                        print(abc)
-                        fields = {}
-                        pae = ''
-                elif line[0].startswith('%'):
-                    if not 'X' in fields:
-                        n += 1
-                        fields['X'] = n
-                    abc = pae2abc(line, fields)
-                    print(abc)
+    for line in f:
+        line = line.strip()
+        if len(line) > 2:
+            if line[0] in valid_abc_chars['fields'] and line[1] == ':':
+                key = line[0]
+                value = line[2:].strip()
+                fields[key] = value
+            elif line[0] == '@' and ':' in line:
+                # Verovio PAE file format
+                key, value = line.split(':', 1)
+                if key == '@clef':
+                    pae += '%%%s' % (value)
+                elif key == '@keysig':
+                    pae += '$%s' % (value)
+                elif key == '@timesig':
+                    pae += '@%s' % (value)
+                elif key == '@data':
+                    pae += ' %s' % (value)
+                    yield (pae, {})
+                    fields = {}
+                    pae = ''
+            elif line[0].startswith('%'):
+                if not 'X' in fields:
+                    n += 1
+                    fields['X'] = n
+                yield (line, fields)
+                fields = {}
+
+
+def read_lines(f, start, end, encoding):
+    '''Yield the decoded lines of binary file f from start up to end'''
+    f.seek(start)
+    position = start
+    for line in f:
+        if position >= end:
+            break
+        position += len(line)
+        yield line.decode(encoding)
+
+
+def count_numbered_records(lines):
+    '''Return how many records of lines read_pae_records() would number
+    itself, for lack of an X field'''
+    n = 0
+    numbered = False
+    for line in lines:
+        line = line.strip()
+        if len(line) > 2:
+            if line[0] in valid_abc_chars['fields'] and line[1] == ':':
+                if line[0] == 'X':
+                    numbered = True
+            elif line[0] == '@' and ':' in line:
+                if line.startswith('@data:'):
+                    numbered = False
+            elif line[0] == '%':
+                if not numbered:
+                    n += 1
+                numbered = False
+    return n
+
+
+def pae_record_boundary(data, position):
+    '''Return the position where the first record of a memory-mapped
+    pae file that ends at or after position ends, so that records are
+    never split, with position counted in bytes'''
+    if position <= 0:
+        return 0
+    size = len(data)
+    start = data.rfind(b'\n', 0, position) + 1
+    while start < size:
+        end = data.find(b'\n', start)
+        if end < 0:
+            end = size
+        else:
+            end += 1
+        line = data[start:end].strip()
+        if len(line) > 2 and (line[:1] == b'%' or
+                              line.startswith(b'@data:')):
+            return end
+        start = end
+    return size
+
+
+def shard_numbered_records(filename, f, start, encoding):
+    '''Return how many records of binary pae file f before start
+    read_pae_records() numbers itself: from the record index of
+    filename if it is up to date, or else by scanning the lines before
+    start, only to count them'''
+    index_filename = record_index_filename(filename)
+    if start and os.path.isfile(index_filename):
+        index = RecordIndex(index_filename)
+        try:
+            if index.current(filename):
+                numbered = index.numbered_before(start)
+                if numbered is not None:
+                    return numbered
+        finally:
+            index.close()
+    return count_numbered_records(read_lines(f, 0, start, encoding))
+
+
+def read_pae_shard(filename, shard, count):
+    '''Yield a (pae, fields) pair for each entry of shard number shard,
+    from 1 on, out of count shards of a pae file.  Shards are ranges of
+    bytes of about the same size, with whole records; entries without
+    X field are numbered as if the whole file was read, counting the
+    ones before the shard with shard_numbered_records().'''
+    encoding = locale.getpreferredencoding(False)
+    with io.open(filename, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        start = end = 0
+        if size:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                start = pae_record_boundary(data, size * (shard - 1) // count)
+                end = pae_record_boundary(data, size * shard // count)
+            finally:
+                data.close()
+        numbered = shard_numbered_records(filename, f, start, encoding)
+        for record in read_pae_records(read_lines(f, start, end, encoding),
+                                       numbered):
+            yield record
+
+
+def shard_arg(value):
+    '''Parse a k/N --shard argument as a (k, N) tuple'''
+    try:
+        (shard, count) = [int(n) for n in value.split('/')]
+    except ValueError:
+        raise argparse.ArgumentTypeError('%s is not k/N' % (value))
+    if not 1 <= shard <= count:
+        raise argparse.ArgumentTypeError('%s: k must be from 1 to N'
+                                         % (value))
+    return (shard, count)
+
+
+def pae_record_spans(f, encoding):
+    '''Yield a (start, end, numbered, ids) tuple for each record of a
+    binary pae file, in file order: the range of bytes of the record,
+    with the information fields before it, how many records before it
+    read_pae_records() numbers itself, and the X and P fields it can
+    be looked up by'''
+    start = position = 0
+    n = 0
+    fields = {}
+    for line in f:
+        position += len(line)
+        line = line.decode(encoding).strip()
+        if len(line) > 2:
+            if line[0] in valid_abc_chars['fields'] and line[1] == ':':
+                fields[line[0]] = line[2:].strip()
+            elif line[0] == '@' and ':' in line:
+                if line.startswith('@data:'):
+                    # Verovio records keep no fields
+                    yield (start, position, n, [])
+                    start = position
                     fields = {}
+            elif line[0] == '%':
+                numbered = n
+                if not 'X' in fields:
+                    n += 1
+                    fields['X'] = str(n)
+                ids = [fields[key] for key in 'XP' if key in fields]
+                yield (start, position, numbered, ids)
+                start = position
+                fields = {}
+
+
+# A record index file starts with record_index_magic and a header of
+# eight unsigned integers, record_index_byte_order the first, to tell a
+# file written with another byte order, the size and modification time
+# of the pae file it was built for, and then the arrays: start and
+# length of every record, how many records before each one are numbered
+# automatically, a hash table of record_index_slots slots (a power of
+# two), each one with the number of an identifier, from 1 on, or 0, the
+# record of each identifier, the offsets of the identifiers and the
+# identifiers themselves, in UTF-8.  Identifiers are placed in the table
+# by their CRC-32, with linear probing, so that a lookup reads only a
+# few of them however large the file is.
+record_index_magic = b'PAERECS1'
+record_index_byte_order = 0x01020304
+
+
+def record_index_filename(filename):
+    '''Return the name of the record index of a pae file'''
+    return filename + '.records'
+
+
+def record_index_hash(identifier):
+    '''Return the hash of a record identifier in a record index'''
+    return binascii.crc32(identifier.encode('utf-8')) & 0xffffffff
+
+
+def build_record_index(filename, index_filename=None):
+    '''Write the record index of a pae file, by default next to it,
+    and return the number of records'''
+    if index_filename is None:
+        index_filename = record_index_filename(filename)
+    encoding = locale.getpreferredencoding(False)
+    spans = array.array('Q')
+    numbers = array.array('I')
+    id_records = array.array('I')
+    id_offsets = array.array('I', [0])
+    identifiers = []
+    size = 0
+    with io.open(filename, 'rb') as f:
+        status = os.fstat(f.fileno())
+        for (start, end, numbered, ids) in pae_record_spans(f, encoding):
+            spans.extend((start, end - start))
+            numbers.append(numbered)
+            for identifier in ids:
+                identifier = identifier.encode('utf-8')
+                identifiers.append(identifier)
+                id_records.append(len(numbers))
+                size += len(identifier)
+                id_offsets.append(size)
+    slots = 2
+    while slots < 2 * len(identifiers):
+        slots *= 2
+    table = array.array('I', [0]) * slots
+    for (i, identifier) in enumerate(identifiers):
+        slot = record_index_hash(identifier.decode('utf-8')) & (slots - 1)
+        while table[slot]:
+            slot = (slot + 1) & (slots - 1)
+        table[slot] = i + 1
+    header = array.array('I', [record_index_byte_order, len(numbers),
+                               len(identifiers), slots, 0, 0, 0, 0])
+    with io.open(index_filename, 'wb') as f:
+        f.write(record_index_magic)
+        header.tofile(f)
+        array.array('Q', [status.st_size, status.st_mtime_ns]).tofile(f)
+        spans.tofile(f)
+        numbers.tofile(f)
+        table.tofile(f)
+        id_records.tofile(f)
+        id_offsets.tofile(f)
+        for identifier in identifiers:
+            f.write(identifier)
+    return len(numbers)
+
+
+class RecordIndex(object):
+    '''Find records of a pae file by their X or P fields, in an index
+    written by build_record_index(), memory-mapped so that only the
+    parts needed are read'''
+
+    def __init__(self, filename):
+        self.f = io.open(filename, 'rb')
+        self.data = mmap.mmap(self.f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.views = []
+        magic = len(record_index_magic)
+        if self.data[:magic] != record_index_magic:
+            self.close()
+            raise ValueError('%s is not a record index' % (filename))
+        header = self.array('I', magic, 8)
+        (byte_order, records, ids, slots) = header[:4]
+        if byte_order != record_index_byte_order:
+            self.close()
+            raise ValueError('%s was built on another platform'
+                             % (filename))
+        self.records = records
+        position = magic + 8 * 4
+        (self.size, self.mtime) = self.array('Q', position, 2)
+        position += 2 * 8
+        self.spans = self.array('Q', position, 2 * records)
+        position += 2 * 8 * records
+        self.numbers = self.array('I', position, records)
+        position += 4 * records
+        self.table = self.array('I', position, slots)
+        position += 4 * slots
+        self.id_records = self.array('I', position, ids)
+        position += 4 * ids
+        self.id_offsets = self.array('I', position, ids + 1)
+        self.identifiers = position + 4 * (ids + 1)
+
+    def array(self, typecode, position, count):
+        '''Return count integers of type typecode of the index from
+        position'''
+        size = array.array(typecode).itemsize
+        view = memoryview(self.data)[position:position + size * count]
+        view = view.cast(typecode)
+        self.views.append(view)
+        return view
+
+    def current(self, filename):
+        '''Tell whether the index was built for filename as it is now'''
+        status = os.stat(filename)
+        return (status.st_size, status.st_mtime_ns) == (self.size, self.mtime)
+
+    def identifier(self, i):
+        '''Return identifier number i, from 0 on'''
+        start = self.identifiers + self.id_offsets[i]
+        end = self.identifiers + self.id_offsets[i + 1]
+        return self.data[start:end].decode('utf-8')
+
+    def find(self, identifier):
+        '''Return the numbers, from 1 on, of the records with an X or
+        P field equal to identifier'''
+        records = []
+        mask = len(self.table) - 1
+        slot = record_index_hash(identifier) & mask
+        while self.table[slot]:
+            i = self.table[slot] - 1
+            if self.identifier(i) == identifier:
+                records.append(self.id_records[i])
+            slot = (slot + 1) & mask
+        return sorted(records)
+
+    def span(self, record_id):
+        '''Return the start and end of a record in the pae file, and
+        how many records before it are numbered automatically'''
+        start = self.spans[2 * (record_id - 1)]
+        end = start + self.spans[2 * (record_id - 1) + 1]
+        return (start, end, self.numbers[record_id - 1])
+
+    def numbered_before(self, position):
+        '''Return how many records before the one that starts at
+        position of the pae file are numbered automatically, or None if
+        no record starts there'''
+        low = 0
+        high = self.records
+        while low < high:
+            middle = (low + high) // 2
+            if self.spans[2 * middle] < position:
+                low = middle + 1
+            else:
+                high = middle
+        if low < self.records and self.spans[2 * low] == position:
+            return self.numbers[low]
+        return None
+
+    def close(self):
+        for view in self.views:
+            view.release()
+        self.views = []
+        self.data.close()
+        self.f.close()
+
+
+def open_record_index(filename):
+    '''Return the record index of a pae file, building it first if it
+    is missing or older than the file'''
+    index_filename = record_index_filename(filename)
+    if os.path.isfile(index_filename):
+        index = RecordIndex(index_filename)
+        if index.current(filename):
+            return index
+        index.close()
+    build_record_index(filename, index_filename)
+    return RecordIndex(index_filename)
+
+
+def read_indexed_records(filename, identifier):
+    '''Yield a (pae, fields) pair for each record of a pae file with an
+    X or P field equal to identifier, or, for #n, for its n-th record,
+    reading only those records'''
+    encoding = locale.getpreferredencoding(False)
+    index = open_record_index(filename)
+    try:
+        if identifier.startswith('#') and identifier[1:].isdigit():
+            records = [int(identifier[1:])]
+            if not 1 <= records[0] <= index.records:
+                records = []
+        else:
+            records = index.find(identifier)
+        spans = [index.span(record_id) for record_id in records]
+    finally:
+        index.close()
+    with io.open(filename, 'rb') as f:
+        for (start, end, numbered) in spans:
+            for record in read_pae_records(read_lines(f, start, end,
+                                                      encoding), numbered):
+                yield record
+
+
+def converter_version():
+    '''Return a hash of the source code of this converter, so that a
+    cache is not reused by a different version'''
+    with io.open(os.path.abspath(__file__).replace('.pyc', '.py'),
+                 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+class ConversionCache(object):
+    '''Remember converted pae strings, the most recently used ones in
+    memory and, optionally, all of them in an SQLite database, keyed
+    by a hash of the pae string and the converter version'''
+
+    def __init__(self, filename=None, size=10000):
+        self.version = converter_version()
+        self.size = size
+        self.recent = collections.OrderedDict()
+        self.pending = []
+        self.hits = 0
+        self.misses = 0
+        self.db = None
+        if filename:
+            self.db = sqlite3.connect(filename)
+            self.db.execute('CREATE TABLE IF NOT EXISTS conversions '
+                            '(key TEXT PRIMARY KEY, abc TEXT)')
+
+    def key(self, pae):
+        '''Return the cache key of pae.  Trailing line breaks or tabs
+        are ignored by the converter, so they are by the key too.'''
+        pae = pae.rstrip('\r\n\t')
+        text = '%s\n%s' % (self.version, pae)
+        return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+    def get(self, pae):
+        '''Return the abc structure of pae, or None if not cached'''
+        key = self.key(pae)
+        abc = self.recent.get(key)
+        if abc is None and self.db is not None:
+            row = self.db.execute('SELECT abc FROM conversions WHERE key = ?',
+                                  (key,)).fetchone()
+            if row:
+                abc = json.loads(row[0])
+        if abc is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self.remember(key, abc)
+        return abc
+
+    def put(self, pae, abc):
+        '''Store the abc structure of pae'''
+        key = self.key(pae)
+        self.remember(key, abc)
+        if self.db is not None:
+            self.pending.append((key, json.dumps(abc)))
+            if len(self.pending) >= 1000:
+                self.flush()
+
+    def remember(self, key, abc):
+        '''Keep abc in memory, forgetting the least recently used
+        conversion if there are too many'''
+        self.recent[key] = abc
+        self.recent.move_to_end(key)
+        if len(self.recent) > self.size:
+            self.recent.popitem(last=False)
+
+    def flush(self):
+        '''Write pending conversions to the database'''
+        if self.db is not None and self.pending:
+            with self.db:
+                self.db.executemany('INSERT OR REPLACE INTO conversions '
+                                    'VALUES (?, ?)', self.pending)
+            self.pending = []
+
+    def close(self):
+        '''Write pending conversions and close the database'''
+        self.flush()
+        if self.db is not None:
+            self.db.close()
+            self.db = None
+
+    def stats(self):
+        '''Return a line with hit and miss counts'''
+        total = self.hits + self.misses
+        if total:
+            ratio = 100.0 * self.hits / total
+        else:
+            ratio = 0.0
+        return 'cache: %d hits, %d misses (%.1f%% hits)' % (self.hits,
+                                                            self.misses,
+                                                            ratio)
+
+
+# Names under which --stats counts the tokens of the tune
+construct_names = {
+    'note': 'notes',
+    'rest': 'rests',
+    'bar': 'bars',
+    'chord': 'chords',
+    'group_start': 'tuplets',
+    'fermata': 'fermatas',
+    'measure_repeat': 'measure repeats',
+    'measure_rest': 'measure rests',
+    'acciaccatura': 'grace notes',
+    'appoggiatura': 'grace notes',
+    'slur': 'slurs',
+    'trill': 'trills',
+    }
+
+# And of the header changes
+header_change_names = {
+    '%': 'clef changes',
+    '$': 'key changes',
+    '@': 'meter changes',
+    }
+
+
+def count_constructs(pae, counts):
+    '''Add to counts how many times each construct is used in pae'''
+    seen = ''
+    position = 0
+    while position < len(pae):
+        c = pae[position]
+        position += 1
+        if c in header_change_names:
+            if c in seen:
+                counts[header_change_names[c]] += 1
+            seen += c
+        elif c == ' ':
+            end = scan_run(pae, position, valid_pae_chars['tune'])
+            for (kind, value) in tokenize_tune(pae[position:end]):
+                if kind in construct_names:
+                    counts[construct_names[kind]] += 1
+                elif kind == 'repetition':
+                    # Only the closing ! has f
+                    if value:
+                        counts['repeats'] += 1
+                elif kind == 'length':
+                    if value.startswith('.'):
+                        value = value[1:]
+                    if len(value) > 1:
+                        counts['rhythmic models'] += 1
+            position = end
+
+
+def timed_convert_pae(pae):
+    '''Return the abc structure of pae, as convert_pae() does, and the
+    time it took'''
+    start = timeit.default_timer()
+    abc = convert_pae(pae)
+    return (abc, timeit.default_timer() - start)
+
+
+def duration(seconds):
+    '''Format a short time in s, ms or us'''
+    if seconds >= 1:
+        return '%g s' % (seconds)
+    elif seconds >= 0.001:
+        return '%g ms' % (round(seconds * 1000, 3))
+    return '%g us' % (round(seconds * 1000000, 3))
+
+
+class ConversionStats(object):
+    '''Collect the time each record takes to convert and the
+    constructs it uses, and report them with the slowest records'''
+
+    # Upper limits of the latency histogram buckets, in seconds
+    buckets = [0.00001, 0.0001, 0.001, 0.01, 0.1, 1]
+
+    def __init__(self, slowest=10):
+        self.start = timeit.default_timer()
+        self.records = 0
+        self.chars = 0
+        self.seconds = 0.0
+        self.histogram = [0] * (len(self.buckets) + 1)
+        self.constructs = collections.Counter()
+        self.size = slowest
+        # A heap of (seconds, record_id, fields), the fastest first
+        self.slowest = []
+
+    def add(self, pae, fields, seconds):
+        '''Account for a converted record'''
+        self.records += 1
+        self.chars += len(pae)
+        self.seconds += seconds
+        self.histogram[bisect.bisect_left(self.buckets, seconds)] += 1
+        count_constructs(pae, self.constructs)
+        item = (seconds, self.records, fields)
+        if len(self.slowest) < self.size:
+            heapq.heappush(self.slowest, item)
+        elif seconds > self.slowest[0][0]:
+            heapq.heapreplace(self.slowest, item)
+
+    def report(self):
+        '''Return the lines of the summary'''
+        elapsed = timeit.default_timer() - self.start
+        out = []
+        out.append('stats: %d records, %d chars in %.3f s '
+                   '(%.0f records/s, %.0f chars/s)' %
+                   (self.records, self.chars, elapsed,
+                    self.records / elapsed, self.chars / elapsed))
+        if self.records:
+            out.append('stats: %.3f s converting, %.3f ms per record' %
+                       (self.seconds, 1000 * self.seconds / self.records))
+        out.append('latency:')
+        top = max(self.histogram) or 1
+        lower = 0
+        for (upper, count) in zip(self.buckets + [None], self.histogram):
+            if upper is None:
+                label = '>= %s' % (duration(lower))
+            else:
+                label = '< %s' % (duration(upper))
+            bar = '#' * (40 * count // top)
+            out.append(('  %10s %8d %s' % (label, count, bar)).rstrip())
+            lower = upper
+        out.append('constructs:')
+        for (name, count) in sorted(self.constructs.items()):
+            out.append('  %-16s %8d' % (name, count))
+        out.append('slowest records:')
+        for (seconds, record_id, fields) in sorted(self.slowest,
+                                                   reverse=True):
+            label = 'record %d' % (record_id)
+            for field in 'XP':
+                if field in fields:
+                    label += ', %s: %s' % (field, fields[field])
+            out.append('  %10s  %s' % (duration(seconds), label))
+        return '\n'.join(out)
+
+
+def failing_record(error, batch, missing, convert):
+    '''Return error, a ValueError raised converting the pae strings
+    missing of batch, with the record it was raised for named in it,
+    found by converting them again one after the other'''
+    failed = set()
+    for pae in missing:
+        try:
+            convert(pae)
+        except ValueError:
+            failed.add(pae)
+            break
+    for (pae, fields) in batch:
+        if pae in failed:
+            label = record_label(fields)
+            if not label:
+                label = pae[:40]
+            return ValueError('%s, in record %s' % (error, label))
+    return error
+
+
+def convert_batch(batch, debug=False, pool=None, chunksize=256, cache=None,
+                  stats=None, stanza=abc_stanza):
+    '''Convert a list of (pae, fields) pairs and return their abc
+    stanzas, built by stanza from the pae string, its abc structure,
+    the fields and debug, using a pool of processes if given.  With a
+    cache, pae strings converted before are not converted again.  With
+    a ConversionStats, the time each record takes is accounted.'''
+
+    converted = {}
+    missing = []
+    for (pae, fields) in batch:
+        if pae in converted:
+            if cache is not None:
+                # Converted just once for the whole batch
+                cache.hits += 1
+        else:
+            if cache is not None:
+                converted[pae] = cache.get(pae)
+            else:
+                converted[pae] = None
+            if converted[pae] is None:
+                missing.append(pae)
+    if stats is not None:
+        return timed_convert_batch(batch, converted, missing, debug, pool,
+                                   chunksize, cache, stats, stanza)
+    try:
+        if pool is not None:
+            results = pool.map(convert_pae, missing, chunksize)
+        else:
+            results = [convert_pae(pae) for pae in missing]
+    except ValueError as error:
+        raise failing_record(error, batch, missing, convert_pae)
+    for (pae, abc) in zip(missing, results):
+        converted[pae] = abc
+        if cache is not None:
+            cache.put(pae, abc)
+    return [stanza(pae, converted[pae], fields, debug)
+            for (pae, fields) in batch]
+
+
+def timed_convert_batch(batch, converted, missing, debug, pool, chunksize,
+                        cache, stats, stanza=abc_stanza):
+    '''Finish convert_batch(), timing each conversion, wherever it
+    runs, and each abc stanza'''
+    try:
+        if pool is not None:
+            results = pool.map(timed_convert_pae, missing, chunksize)
+        else:
+            results = [timed_convert_pae(pae) for pae in missing]
+    except ValueError as error:
+        raise failing_record(error, batch, missing, convert_pae)
+    times = {}
+    for (pae, (abc, seconds)) in zip(missing, results):
+        converted[pae] = abc
+        times[pae] = seconds
+        if cache is not None:
+            cache.put(pae, abc)
+    stanzas = []
+    for (pae, fields) in batch:
+        start = timeit.default_timer()
+        stanzas.append(stanza(pae, converted[pae], fields, debug))
+        seconds = timeit.default_timer() - start
+        # Only the first of repeated pae strings was converted
+        seconds += times.pop(pae, 0.0)
+        stats.add(pae, fields, seconds)
+    return stanzas
+
+
+def convert_records(records, debug=False, jobs=1, chunksize=256, cache=None,
+                    stats=None, stanza=abc_stanza):
+    '''Convert an iterable of (pae, fields) pairs.  Lazily yield a
+    (record_id, fields, abc) tuple for each one, record_id being its
+    position in the input, starting at 1, and abc what stanza builds,
+    the abc stanza by default.  With more than one job, records are
+    converted in chunks by a pool of processes, but yielded in the same
+    order as they were read.  With a ConversionCache, pae strings
+    converted before are not converted again, and with a
+    ConversionStats, conversions are timed.'''
+
+    # Slicing a list, unlike an iterator, would start over every time
+    records = iter(records)
+    record_ids = itertools.count(1)
+    pool = None
+    batch_size = 1
+    if jobs > 1:
+        pool = multiprocessing.Pool(jobs, set_conversion_limits,
+                                    (max_tune_elements, max_abc_length))
+        # Feed the pool a batch at a time, so that memory does not
+        # grow with the size of the input
+        batch_size = jobs * chunksize * 4
+    try:
+        batch = list(itertools.islice(records, batch_size))
+        while batch:
+            converted = convert_batch(batch, debug, pool, chunksize, cache,
+                                      stats, stanza)
+            for ((pae, fields), abc) in zip(batch, converted):
+                yield (next(record_ids), fields, abc)
+            batch = list(itertools.islice(records, batch_size))
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+
+
+def iter_convert(lines, debug=False, jobs=1, chunksize=256, cache=None,
+                 stats=None):
+    '''Convert an iterable of lines with PAE entries, with optional
+    ABC fields, such as an open file or sys.stdin, as convert_records()
+    does'''
+    return convert_records(read_pae_records(lines), debug, jobs, chunksize,
+                           cache, stats)
+
+
+def marc_leader_length(leader):
+    '''Return the record length of a MARC21 leader, or 0 if leader
+    does not look like one'''
+    if len(leader) < 24 or not leader[:5].isdigit():
+        return 0
+    length = int(leader[:5])
+    if length < 24:
+        return 0
+    return length
+
+
+def marc_record_starts(data):
+    '''Yield the position of every record in data, a buffer with
+    concatenated MARC21 (ISO 2709) records, jumping from one to the
+    next with the record length in their leaders'''
+    position = 0
+    size = len(data)
+    while position + 24 <= size:
+        length = marc_leader_length(data[position:position+24])
+        if length:
+            yield position
+            position += length
+        else:
+            # Line breaks or garbage between records; skip them
+            position += 1
+
+
+def read_marc_stream(f):
+    '''Yield every MARC21 (ISO 2709) record read from the binary file
+    f as a bytes string, for inputs that cannot be memory-mapped'''
+    leader = f.read(24)
+    while len(leader) == 24:
+        length = marc_leader_length(leader)
+        if length:
+            yield leader + f.read(length - 24)
+            leader = f.read(24)
+        else:
+            # Line breaks or garbage between records; skip them
+            leader = leader[1:] + f.read(1)
+
+
+def marc_fields(data, start, tags):
+    '''Yield (tag, value) for the fields of the MARC21 record at
+    data[start:] whose tag is in tags, value being its raw bytes.  Only
+    the leader, the directory and the selected fields are read.'''
+    base = int(data[start+12:start+17])
+    directory = data[start+24:start+base-1]
+    for i in range(0, len(directory) - 11, 12):
+        tag = directory[i:i+3]
+        if tag in tags:
+            length = int(directory[i+3:i+7])
+            offset = start + base + int(directory[i+7:i+12])
+            yield (tag, data[offset:offset+length].rstrip(b'\x1e'))
+
+
+def marc_subfields(value):
+    '''Return a dict with the first occurrence of every subfield of
+    a MARC21 data field value, decoded as UTF-8'''
+    subfields = {}
+    # The first part are the indicators
+    for subfield in value.split(b'\x1f')[1:]:
+        code = subfield[:1].decode('ascii', 'replace')
+        if code and not code in subfields:
+            subfields[code] = subfield[1:].decode('utf-8', 'replace').strip()
+    return subfields
+
+
+def marc_record_fields(data, start):
+    '''Return a list of (tag, value) pairs for the fields of the MARC21
+    record at data[start:] that are used for conversion: the 001
+    control number, with a string value, and the 031, 100 and 245 data
+    fields, with a dict of subfields as value.  A record with a corrupt
+    base address or directory has no fields, so that it is skipped
+    instead of stopping the whole conversion.'''
+    fields = []
+    try:
+        for (tag, value) in marc_fields(data, start,
+                                        (b'001', b'031', b'100', b'245')):
+            tag = tag.decode('ascii')
+            if tag == '001':
+                fields.append((tag,
+                               value.decode('utf-8', 'replace').strip()))
+            else:
+                fields.append((tag, marc_subfields(value)))
+    except ValueError:
+        print('Warning: skipping a MARC21 record with a corrupt directory',
+              file=sys.stderr)
+        return []
+    return fields
+
+
+def read_marc_records(records):
+    '''Read a (tag, value) list for each MARC21 record, as returned by
+    marc_record_fields(), and yield a (pae, fields) pair for each
+    incipit in their 031 fields, with $g clef, $n key signature, $o
+    time signature and $p notes.  The 001 control number, 100 $a
+    composer, 245 $a title and 031 $t text incipit become the P, C, T
+    and w abc fields.'''
+
+    n = 0
+    for record in records:
+        fields = {}
+        incipits = []
+        for (tag, value) in record:
+            if tag == '001':
+                fields['P'] = value
+            elif tag == '031':
+                incipits.append(value)
+            elif tag == '100':
+                if 'a' in value:
+                    # Remove the ISBD comma before $d, but not the
+                    # period of initials, as in Bach, J.S.
+                    fields['C'] = value['a'].rstrip(' ,')
+            elif tag == '245':
+                if 'a' in value:
+                    # Remove ISBD punctuation
+                    fields['T'] = value['a'].rstrip(' /:;=,.')
+        for incipit in incipits:
+            if not incipit.get('p'):
+                continue
+            pae = '%%%s$%s@%s %s' % (incipit.get('g', ''),
+                                     incipit.get('n', ''),
+                                     incipit.get('o', ''),
+                                     incipit['p'])
+            n += 1
+            incipit_fields = dict(fields)
+            incipit_fields['X'] = n
+            if incipit.get('t'):
+                incipit_fields['w'] = incipit['t']
+            yield (pae, incipit_fields)
+
+
+def read_marc_file(filename):
+    '''Yield a (pae, fields) pair for each incipit of a MARC21 file,
+    memory-mapping it if possible; - stands for standard input'''
+    with open_binary(filename) as f:
+        data = None
+        if filename != '-' and isinstance(f, io.BufferedReader):
+            # Compressed files can only be read as a stream
+            try:
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except (ValueError, EnvironmentError):
+                # Empty files, pipes and the like cannot be mapped
+                data = None
+        if data is None:
+            records = (marc_record_fields(data, 0)
+                       for data in read_marc_stream(f))
+            for record in read_marc_records(records):
+                yield record
+            return
+        try:
+            records = (marc_record_fields(data, start)
+                       for start in marc_record_starts(data))
+            for record in read_marc_records(records):
+                yield record
+        finally:
+            data.close()
+
+
+def xml_local_name(tag):
+    '''Return an ElementTree tag without its {namespace}'''
+    return tag.rsplit('}', 1)[-1]
+
+
+def read_marcxml_records(f):
+    '''Parse the MARCXML file f incrementally and yield a (tag, value)
+    list for each record, as marc_record_fields() does.  Every record
+    is dropped once used, so memory does not grow with the file.'''
+    root = None
+    for (event, element) in ElementTree.iterparse(f, ('start', 'end')):
+        if root is None:
+            root = element
+        if event != 'end' or xml_local_name(element.tag) != 'record':
+            continue
+        fields = []
+        for field in element:
+            name = xml_local_name(field.tag)
+            tag = field.get('tag', '')
+            if name == 'controlfield' and tag == '001':
+                fields.append((tag, (field.text or '').strip()))
+            elif name == 'datafield' and tag in ('031', '100', '245'):
+                subfields = {}
+                for subfield in field:
+                    code = subfield.get('code', '')
+                    if code and not code in subfields:
+                        subfields[code] = (subfield.text or '').strip()
+                fields.append((tag, subfields))
+        yield fields
+        element.clear()
+        # Cleared records still hang from the collection; drop them
+        root.clear()
+
+
+def read_marcxml_file(filename):
+    '''Yield a (pae, fields) pair for each incipit of a MARCXML file;
+    - stands for standard input'''
+    with open_binary(filename) as f:
+        for record in read_marc_records(read_marcxml_records(f)):
+            yield record
+
+
+def read_records(filename, format='pae'):
+    '''Yield a (pae, fields) pair for each incipit of a pae, MARC21
+    ('marc') or MARCXML ('marcxml') file'''
+    if format == 'marc':
+        records = read_marc_file(filename)
+    elif format == 'marcxml':
+        records = read_marcxml_file(filename)
+    else:
+        with open_input(filename) as f:
+            for record in read_pae_records(f):
+                yield record
+        return
+    for record in records:
+        yield record
+
+
+# Octave number of the pae octaves, middle C being in octave 4
+pae_octave_numbers = {
+    ",,,": 1,
+    ",,": 2,
+    ",": 3,
+    "'": 4,
+    "''": 5,
+    "'''": 6,
+    "''''": 7,
+    }
+
+# Semitones of each note name over C
+pae_note_semitones = {
+    'C': 0,
+    'D': 2,
+    'E': 4,
+    'F': 5,
+    'G': 7,
+    'A': 9,
+    'B': 11,
+    }
+
+# Semitones that abc accidentals add
+abc_accidental_semitones = {
+    '^': 1,
+    '_': -1,
+    '=': 0,
+    }
+
+
+def key_alterations(pae):
+    '''Return the semitones that a pae key signature adds to each
+    note name, such as {'B': -1, 'E': -1} for bBE'''
+    alterations = {}
+    alteration = 0
+    for c in pae:
+        if c == 'x':
+            alteration = 1
+        elif c == 'b':
+            alteration = -1
+        elif c == 'n':
+            alteration = 0
+        elif c in pae_note_semitones:
+            alterations[c] = alteration
+    return alterations
+
+
+def abc_length_fraction(abc):
+    '''Return an abc note length, such as /2 or 3/2, as a fraction of
+    the 1/4 unit note length'''
+    try:
+        if not abc:
+            return fractions.Fraction(1)
+        elif abc.startswith('/'):
+            length = fractions.Fraction(1, int(abc[1:]))
+        else:
+            length = fractions.Fraction(abc)
+    except (ValueError, ZeroDivisionError):
+        # Lengths the converter passes as they are
+        return fractions.Fraction(1)
+    if length <= 0:
+        # Such as a dotted longa, 0., passed as it is too
+        return fractions.Fraction(1)
+    return length
+
+
+def pae_melody(pae):
+    '''Return the melody of a pae string, as parse_pae() understands
+    it, as a list of (pitch, length, bar) tuples: the MIDI number of
+    each note, with its key signature and accidentals applied, its
+    length in quarter notes, and the number of bars before it.  Rests,
+    grace notes and all but the first note of chords are left out.'''
+    melody = []
+    number = ''
+    key = {}
+    bar = 0
+    position = 0
+    while position < len(pae):
+        c = pae[position]
+        position += 1
+        if c == '$':
+            end = scan_run(pae, position, valid_pae_chars['accidentals'])
+            key = key_alterations(pae[position:end])
+            position = end
+        elif c == ' ':
+            end = scan_run(pae, position, valid_pae_chars['tune'])
+            (elements, number) = parse_tune(pae[position:end], number)
+            position = end
+            # Accidentals last until the end of the measure
+            measure = {}
+            chord = False
+            for element in elements:
+                kind = element.kind
+                if kind == 'bar':
+                    measure = {}
+                    bar += 1
+                elif kind == 'bracket':
+                    chord = element.text == '['
+                    first = True
+                elif kind == 'note':
+                    if element.grace or element.octave not in pae_octaves:
+                        continue
+                    if chord:
+                        if not first:
+                            continue
+                        first = False
+                    note = (element.pitch, element.octave)
+                    if element.accidental:
+                        measure[note] = abc_accidental_semitones[
+                            element.accidental]
+                    alteration = measure.get(note,
+                                             key.get(element.pitch, 0))
+                    pitch = (12 * (pae_octave_numbers[element.octave] + 1) +
+                             pae_note_semitones[element.pitch] + alteration)
+                    length = abc_length_fraction(
+                        notelength2abc(element.length))
+                    melody.append((pitch, length, bar))
+    return melody
+
+
+# Number of intervals (or length ratios) of the indexed n-grams
+ngram_size = 4
+
+# Flag of the rhythmic n-grams, to keep them apart from the melodic ones
+ngram_rhythm_flag = 1 << 24
+
+# Rhythmic n-grams found in more than this share of the records, such as
+# runs of eighth notes, are too common to tell records apart, and are
+# not scored by searches
+ngram_common_share = 0.25
+
+
+def pack_ngram(values, offset):
+    '''Pack ngram_size small integers, from -offset to 63 - offset,
+    into a single one'''
+    key = 0
+    for value in values:
+        key = (key << 6) | (max(-offset, min(value, 63 - offset)) + offset)
+    return key
+
+
+def melody_ngrams(melody):
+    '''Return the melodic and the rhythmic n-grams of a melody, as
+    integers.  Melodic ones are made of intervals, so they do not
+    depend on transposition; rhythmic ones of the ratios between
+    consecutive lengths, so they do not depend on the unit length.'''
+    intervals = []
+    ratios = []
+    for ((pitch, length, bar), (next_pitch, next_length, next_bar)) in zip(
+            melody, melody[1:]):
+        intervals.append(next_pitch - pitch)
+        # In half doublings, so that dotted notes count
+        ratios.append(int(round(2 * math.log(next_length / length, 2))))
+    melodic = []
+    rhythmic = []
+    for i in range(len(intervals) - ngram_size + 1):
+        melodic.append(pack_ngram(intervals[i:i+ngram_size], 32))
+        rhythmic.append(ngram_rhythm_flag |
+                        pack_ngram(ratios[i:i+ngram_size], 32))
+    return (melodic, rhythmic)
+
+
+def record_label(fields):
+    '''Return the information fields that identify a record, on a
+    line'''
+    return ', '.join(['%s: %s' % (field, fields[field])
+                      for field in 'XPCT' if field in fields])
+
+
+# An n-gram index file starts with this, followed by a header of eight
+# unsigned 32 bit integers: a byte order mark, ngram_size, and the
+# number of keys, postings and records.  Then, as arrays of the same
+# integers, come the sorted n-gram keys, the offsets of the postings
+# of each key, the postings (numbers of the records that contain each
+# n-gram, from 1 on), and the offsets of the record labels, followed
+# by the labels themselves, in UTF-8.
+ngram_index_magic = b'PAENGRM1'
+ngram_index_byte_order = 0x01020304
+
+
+def build_ngram_index(records, filename):
+    '''Write an n-gram index of (pae, fields) records to filename, and
+    return the number of records and of distinct n-grams'''
+    postings = {}
+    label_offsets = array.array('I', [0])
+    labels = []
+    size = 0
+    record_id = 0
+    for (record_id, (pae, fields)) in enumerate(records, 1):
+        try:
+            melody = pae_melody(pae)
+        except (IndexError, ValueError):
+            # The converter cannot cope with it either
+            melody = []
+        (melodic, rhythmic) = melody_ngrams(melody)
+        for key in set(melodic + rhythmic):
+            if key not in postings:
+                postings[key] = array.array('I')
+            postings[key].append(record_id)
+        label = record_label(fields).encode('utf-8')
+        labels.append(label)
+        size += len(label)
+        label_offsets.append(size)
+    keys = array.array('I', sorted(postings))
+    offsets = array.array('I', [0])
+    total = 0
+    for key in keys:
+        total += len(postings[key])
+        offsets.append(total)
+    header = array.array('I', [ngram_index_byte_order, ngram_size,
+                               len(keys), total, record_id, 0, 0, 0])
+    with io.open(filename, 'wb') as f:
+        f.write(ngram_index_magic)
+        header.tofile(f)
+        keys.tofile(f)
+        offsets.tofile(f)
+        for key in keys:
+            postings[key].tofile(f)
+        label_offsets.tofile(f)
+        for label in labels:
+            f.write(label)
+    return (record_id, len(keys))
+
+
+class NgramIndex(object):
+    '''Search incipits in an index written by build_ngram_index(),
+    memory-mapped so that only the parts needed are read'''
+
+    def __init__(self, filename):
+        self.f = io.open(filename, 'rb')
+        self.data = mmap.mmap(self.f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.views = []
+        magic = len(ngram_index_magic)
+        if self.data[:magic] != ngram_index_magic:
+            self.close()
+            raise ValueError('%s is not an n-gram index' % (filename))
+        header = self.array(magic, 8)
+        (byte_order, size, keys, total, records) = header[:5]
+        if byte_order != ngram_index_byte_order or size != ngram_size:
+            self.close()
+            raise ValueError('%s was built on another platform or version'
+                             % (filename))
+        self.records = records
+        position = magic + 8 * 4
+        self.keys = self.array(position, keys)
+        position += 4 * keys
+        self.offsets = self.array(position, keys + 1)
+        position += 4 * (keys + 1)
+        self.postings = self.array(position, total)
+        position += 4 * total
+        self.label_offsets = self.array(position, records + 1)
+        self.labels = position + 4 * (records + 1)
+
+    def array(self, position, count):
+        '''Return count unsigned integers of the index from position'''
+        view = memoryview(self.data)[position:position + 4 * count]
+        view = view.cast('I')
+        self.views.append(view)
+        return view
+
+    def find(self, key):
+        '''Return the numbers of the records that contain an n-gram'''
+        i = bisect.bisect_left(self.keys, key)
+        if i < len(self.keys) and self.keys[i] == key:
+            return self.postings[self.offsets[i]:self.offsets[i+1]]
+        return []
+
+    def label(self, record_id):
+        '''Return the information fields of a record'''
+        start = self.labels + self.label_offsets[record_id - 1]
+        end = self.labels + self.label_offsets[record_id]
+        return self.data[start:end].decode('utf-8')
+
+    def search(self, pae, top=10):
+        '''Return up to top (score, record_id, label) tuples for the
+        records whose melody best matches the pae fragment, from best
+        to worst.  The score is the share of the melodic n-grams of
+        the fragment that the record has, with those that match the
+        rhythm too counting a bit more, unless the rhythm is in so many
+        records that it tells little.'''
+        if not pae.startswith('%') and ' ' not in pae:
+            # A bare tune, without clef, key or time signature
+            pae = ' ' + pae
+        (melodic, rhythmic) = melody_ngrams(pae_melody(pae))
+        if not melodic:
+            raise ValueError('A query needs at least %d notes' %
+                             (ngram_size + 1))
+        matches = collections.Counter()
+        for key in set(melodic):
+            matches.update(self.find(key))
+        rhythm = collections.Counter()
+        scored_rhythms = 0
+        for key in set(rhythmic):
+            postings = self.find(key)
+            if len(postings) > ngram_common_share * self.records:
+                continue
+            scored_rhythms += 1
+            if len(postings) <= len(matches):
+                for record_id in postings:
+                    if record_id in matches:
+                        rhythm[record_id] += 1
+                continue
+            # Fewer matches than postings: look each one up in the
+            # sorted postings
+            for record_id in matches:
+                i = bisect.bisect_left(postings, record_id)
+                if i < len(postings) and postings[i] == record_id:
+                    rhythm[record_id] += 1
+        best = len(set(melodic)) + 0.5 * scored_rhythms
+        scored = [((matches[record_id] + 0.5 * rhythm[record_id]) / best,
+                   record_id) for record_id in matches]
+        return [(score, record_id, self.label(record_id))
+                for (score, record_id) in heapq.nlargest(top, scored)]
+
+    def close(self):
+        for view in self.views:
+            view.release()
+        self.views = []
+        self.data.close()
+        self.f.close()
+
+
+# Notes per shingle of the melodies that --dedup compares, and the
+# banding of their MinHash signatures: records that share all the rows
+# of a band are compared
+dedup_shingle_size = 3
+dedup_bands = 8
+dedup_rows = 4
+
+# Each MinHash function xors the shingle hashes with one of these
+minhash_masks = [int(hashlib.sha1(str(i).encode('ascii')).hexdigest()[:16], 16)
+                 for i in range(dedup_bands * dedup_rows)]
+
+
+def melody_signature(pae):
+    '''Return the MinHash signature of the melody of pae, as a tuple of
+    integers, or None if it is too short to have one.  Melodies are
+    compared by their pitches and lengths, so that octave marks,
+    length digits, rhythmic models or repeats written in a different
+    way do not matter.'''
+    try:
+        melody = pae_melody(pae)
+    except (IndexError, ValueError):
+        return None
+    # Lengths in 1/256 of a quarter note, the shortest one in pae
+    codes = [(pitch << 16) | min(256 * length.numerator //
+                                 length.denominator, 0xffff)
+             for (pitch, length, bar) in melody]
+    size = dedup_shingle_size
+    if len(codes) < size:
+        return None
+    hashes = set()
+    for i in range(len(codes) - size + 1):
+        hashes.add(hash(tuple(codes[i:i+size])) & 0xffffffffffffffff)
+    count = len(hashes)
+    return tuple([min(map(operator.xor, hashes,
+                          itertools.repeat(mask, count))) & 0xffffffff
+                  for mask in minhash_masks])
+
+
+def find_duplicates(records, threshold=0.8, jobs=1, chunksize=256):
+    '''Return the clusters of likely duplicates among (pae, fields)
+    records, as lists of record numbers, from 1 on, together with the
+    labels of all records.  Instead of comparing every pair, only
+    records that share a band of their MinHash signatures are compared,
+    and joined if their signatures agree at least by threshold.'''
+
+    labels = []
+    record_ids = array.array('I')
+    signatures = array.array('I')
+    pool = None
+    batch_size = 1024
+    if jobs > 1:
+        pool = multiprocessing.Pool(jobs, set_conversion_limits,
+                                    (max_tune_elements, max_abc_length))
+        batch_size = jobs * chunksize * 4
+    try:
+        batch = list(itertools.islice(records, batch_size))
+        while batch:
+            paes = [pae for (pae, fields) in batch]
+            if pool is not None:
+                batch_signatures = pool.map(melody_signature, paes,
+                                            chunksize)
+            else:
+                batch_signatures = [melody_signature(pae) for pae in paes]
+            for ((pae, fields), signature) in zip(batch, batch_signatures):
+                labels.append(record_label(fields))
+                if signature is not None:
+                    record_ids.append(len(labels))
+                    signatures.extend(signature)
+            batch = list(itertools.islice(records, batch_size))
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+
+    # Join similar records in a union-find forest
+    size = len(minhash_masks)
+    parent = array.array('I', range(len(record_ids)))
+
+    def root(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    def similarity(i, j):
+        equal = 0
+        for (a, b) in zip(signatures[i*size:(i+1)*size],
+                          signatures[j*size:(j+1)*size]):
+            if a == b:
+                equal += 1
+        return equal / size
+
+    for band in range(dedup_bands):
+        # A band at a time, so that only one table is in memory
+        buckets = {}
+        for i in range(len(record_ids)):
+            start = i * size + band * dedup_rows
+            key = signatures[start:start + dedup_rows].tobytes()
+            # Compare with the first record of the bucket only; the
+            # other bands give other chances to be joined
+            first = buckets.setdefault(key, i)
+            if first != i and root(first) != root(i):
+                if similarity(first, i) >= threshold:
+                    parent[root(i)] = root(first)
+
+    clusters = collections.OrderedDict()
+    for i in range(len(record_ids)):
+        clusters.setdefault(root(i), []).append(record_ids[i])
+    clusters = [cluster for cluster in clusters.values() if len(cluster) > 1]
+    clusters.sort()
+    return (clusters, labels)
+
+
+def melody_columns(records):
+    '''Return the melodies of (pae, fields) records as columns: arrays
+    of the pitch, length (numerator and denominator, in quarter notes)
+    and bar number of every note of every record, one after the other,
+    and an array of offsets, where the notes of record i (from 0 on)
+    are those from offsets[i] to offsets[i+1].  Also return the labels
+    of the records.'''
+    columns = {
+        'pitch': array.array('h'),
+        'numerator': array.array('i'),
+        'denominator': array.array('i'),
+        'bar': array.array('i'),
+        'offsets': array.array('q', [0]),
+        }
+    labels = []
+    for (pae, fields) in records:
+        try:
+            melody = pae_melody(pae)
+        except (IndexError, ValueError):
+            # The converter cannot cope with it either
+            melody = []
+        for (pitch, length, bar) in melody:
+            columns['pitch'].append(pitch)
+            columns['numerator'].append(length.numerator)
+            columns['denominator'].append(length.denominator)
+            columns['bar'].append(bar)
+        columns['offsets'].append(len(columns['pitch']))
+        labels.append(record_label(fields))
+    return (columns, labels)
+
+
+def export_npz(records, filename):
+    '''Write the melodies of (pae, fields) records to a NumPy .npz file,
+    with the columns of melody_columns() as arrays, plus the labels of
+    the records, and return the number of records and notes'''
+    try:
+        # Imported here, so that it costs nothing to other commands
+        import numpy
+    except ImportError:
+        raise RuntimeError('NumPy is needed to write .npz files')
+    (columns, labels) = melody_columns(records)
+    arrays = {}
+    for (name, column) in columns.items():
+        # Share the memory of the column, with the same type
+        arrays[name] = numpy.frombuffer(column, dtype=column.typecode)
+    arrays['labels'] = numpy.array(labels, dtype=str)
+    numpy.savez_compressed(filename, **arrays)
+    return (len(labels), len(columns['pitch']))
+
+
+# First bytes of the compressed files that are read, and the modules
+# that decompress them
+compression_magic = [
+    (b'\x1f\x8b', gzip),
+    (b'BZh', bz2),
+    (b'\xfd7zXZ\x00', lzma),
+    ]
+
+# Extensions of the compressed files that are written, and the modules
+# that compress them
+compression_extensions = {
+    '.gz': gzip,
+    '.bz2': bz2,
+    '.xz': lzma,
+    }
+
+
+def compression(magic):
+    '''Return the module that decompresses a file starting with the
+    magic bytes, or None if it is not compressed'''
+    for (signature, module) in compression_magic:
+        if magic.startswith(signature):
+            return module
+    return None
+
+
+def compressed_file(filename):
+    '''Tell whether filename is compressed'''
+    with io.open(filename, 'rb') as f:
+        return compression(f.read(6)) is not None
+
+
+def open_binary(filename):
+    '''Open filename for reading bytes; - stands for standard input.  A
+    gzip, bzip2 or xz compressed file is decompressed as it is read.'''
+    if filename == '-':
+        # Do not close standard input along with the returned file
+        f = io.open(sys.stdin.fileno(), 'rb', closefd=False)
+    else:
+        f = io.open(filename, 'rb')
+    # Peeking does not consume the bytes, so that standard input can be
+    # read from the start too
+    module = compression(f.peek(6)[:6])
+    if module is None:
+        return f
+    if filename == '-':
+        return module.open(f, 'rb')
+    f.close()
+    return module.open(filename, 'rb')
+
+
+def open_input(filename):
+    '''Open filename for reading text, decompressing it if needed; -
+    stands for standard input'''
+    return io.TextIOWrapper(open_binary(filename))
+
+
+def open_output(filename='', buffer_size=1024*1024, append=False):
+    '''Return a file writing to filename, or to standard output if
+    none, through a large buffer, to avoid a system call for every
+    stanza.  A filename ending in .gz, .bz2 or .xz is compressed, a
+    buffer at a time.'''
+    if not filename:
+        sys.stdout.flush()
+        return io.open(sys.stdout.fileno(), 'w', buffering=buffer_size,
+                       closefd=False)
+    mode = 'wb'
+    if append:
+        mode = 'ab'
+    module = compression_extensions.get(os.path.splitext(filename)[1])
+    if module is None:
+        return io.open(filename, mode[0], buffering=buffer_size)
+    return io.TextIOWrapper(io.BufferedWriter(module.open(filename, mode),
+                                              buffer_size))
+
+
+def write_abc(records, out=None, jobs=1, debug=False, cache=None,
+              stats=None, header=True):
+    '''Convert (pae, fields) pairs and write the abc stanzas to out,
+    standard output by default, after the abc file header if asked
+    to'''
+
+    if out is None:
+        out = sys.stdout
+    if header:
+        out.write('%abc-2.1\n\n')
+    for (record_id, fields, abc) in convert_records(records, debug, jobs,
+                                                    cache=cache,
+                                                    stats=stats):
+        out.write(abc)
+        out.write('\n')
+    return
+
+
+def record_identifier(fields, record_id):
+    '''Return the identifier of a record: its P field, or its X field
+    if it has none, or else # and its number in the input, record_id,
+    as for --record'''
+    if 'P' in fields:
+        return fields['P']
+    elif 'X' in fields:
+        return str(fields['X'])
+    # Verovio records have no fields
+    return '#%d' % (record_id)
+
+
+def repeated_identifier(key, occurrences):
+    '''Count key in occurrences, a Counter, and return it unchanged the
+    first time, and as key#n the n-th time, so that records sharing an
+    identifier, such as the incipits of a MARC record, which all have
+    its 001 as P field, are kept apart'''
+    occurrences[key] += 1
+    if occurrences[key] > 1:
+        key = '%s#%d' % (key, occurrences[key])
+    return key
+
+
+def sqlite_row(pae, abc, fields={}, debug=False):
+    '''Build the columns of the incipits table, after the id and the
+    record number, from the abc structure of a converted pae string'''
+    header = abc['header']
+    return (pae, header['timesig'], header['accidentals'], header['clef'],
+            abc['body']['tune'], abc_stanza(pae, abc, fields, debug))
+
+
+def write_sqlite(records, filename, jobs=1, debug=False, cache=None,
+                 stats=None, batch_size=10000):
+    '''Convert (pae, fields) pairs and write them to the SQLite database
+    filename: the pae string, abc header values, abc tune and whole abc
+    stanza of every record to the incipits table, and its fields to the
+    fields table.  Records are identified by record_identifier(), and
+    the second, third... with the same identifier by
+    repeated_identifier(); a record already there is replaced.  Rows
+    are written batch_size records at a time, each batch in a single
+    transaction.  Return the number of records.'''
+
+    db = sqlite3.connect(filename)
+    db.execute('CREATE TABLE IF NOT EXISTS incipits '
+               '(id TEXT PRIMARY KEY, record INTEGER, pae TEXT, meter TEXT, '
+               'key TEXT, clef TEXT, tune TEXT, abc TEXT)')
+    db.execute('CREATE TABLE IF NOT EXISTS fields '
+               '(id TEXT, field TEXT, value TEXT, PRIMARY KEY (id, field)) '
+               'WITHOUT ROWID')
+    occurrences = collections.Counter()
+    count = 0
+    try:
+        pending = collections.OrderedDict()
+        for (record_id, fields, row) in convert_records(records, debug, jobs,
+                                                        cache=cache,
+                                                        stats=stats,
+                                                        stanza=sqlite_row):
+            count += 1
+            key = repeated_identifier(record_identifier(fields, record_id),
+                                      occurrences)
+            pending[key] = ((key, record_id) + row,
+                            [(key, field, str(fields[field]))
+                             for field in fields])
+            if len(pending) >= batch_size:
+                write_sqlite_batch(db, pending)
+                pending.clear()
+        write_sqlite_batch(db, pending)
+    finally:
+        db.close()
+    return count
+
+
+def write_sqlite_batch(db, pending):
+    '''Write an id: (row, field rows) mapping of write_sqlite() in a
+    single transaction'''
+    with db:
+        db.executemany('INSERT INTO incipits VALUES (?, ?, ?, ?, ?, ?, ?, ?) '
+                       'ON CONFLICT (id) DO UPDATE SET '
+                       'record = excluded.record, pae = excluded.pae, '
+                       'meter = excluded.meter, key = excluded.key, '
+                       'clef = excluded.clef, tune = excluded.tune, '
+                       'abc = excluded.abc',
+                       [row for (row, field_rows) in pending.values()])
+        # Fields that a record no longer has must go too
+        db.executemany('DELETE FROM fields WHERE id = ?',
+                       [(key,) for key in pending])
+        db.executemany('INSERT INTO fields VALUES (?, ?, ?)',
+                       [field_row for (row, field_rows) in pending.values()
+                        for field_row in field_rows])
+
+
+def record_contents(pae, fields={}):
+    '''Return the lines of text a record is made of: its pae string and
+    its fields, but for an X field numbered by the converter, as it
+    changes whenever a record is added or deleted before'''
+    text = [pae]
+    for field in sorted(fields):
+        if field == 'X' and isinstance(fields[field], int):
+            # Only automatic numbers are not strings
+            continue
+        text.append('%s: %s' % (field, fields[field]))
+    return text
+
+
+def record_hash(version, pae, fields={}, debug=False):
+    '''Return a hash of everything the abc stanza of a record is built
+    from: the converter version, the debug mode and its
+    record_contents()'''
+    text = [version, str(debug)] + record_contents(pae, fields)
+    return hashlib.sha1('\n'.join(text).encode('utf-8')).hexdigest()
+
+
+def manifest_identifier(pae, fields={}):
+    '''Return the identifier of a record in a manifest: its P field, or
+    else its X field if it was in the input, or else a hash of its
+    record_contents(), rather than its position, which changes
+    whenever a record is added or deleted before'''
+    if 'P' in fields:
+        return fields['P']
+    elif isinstance(fields.get('X'), str):
+        return fields['X']
+    text = '\n'.join(record_contents(pae, fields))
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+def write_manifest_abc(records, filename, out=None, jobs=1, debug=False,
+                       cache=None, stats=None, chunksize=256,
+                       batch_size=10000):
+    '''Convert (pae, fields) pairs and write the abc stanzas to out,
+    standard output by default, as write_abc() does, but converting
+    only the records that are new or changed since the last run: the
+    SQLite manifest filename keeps, for every record identifier, as
+    manifest_identifier() makes them, the record_hash() and abc stanza
+    of the record, and the stanzas of unchanged records are taken from
+    it, with their automatic X field renumbered.  The n-th record with
+    the same identifier, such as the n-th incipit of a MARC record, is
+    kept as identifier#n.  Records of the manifest that are no longer
+    in the input are removed from it, once the whole input has been
+    read.  Return the number of records, of new and of changed ones,
+    and the list of deleted identifiers.'''
+
+    if out is None:
+        out = sys.stdout
+    version = converter_version()
+    db = sqlite3.connect(filename)
+    db.execute('CREATE TABLE IF NOT EXISTS manifest '
+               '(id TEXT PRIMARY KEY, hash TEXT, abc TEXT)')
+    # Identifiers found in the input, to tell which ones are gone
+    db.execute('CREATE TEMP TABLE seen (id TEXT PRIMARY KEY)')
+    occurrences = collections.Counter()
+    records = iter(records)
+    count = 0
+    new = 0
+    changed = 0
+    pool = None
+    if jobs > 1:
+        pool = multiprocessing.Pool(jobs, set_conversion_limits,
+                                    (max_tune_elements, max_abc_length))
+    try:
+        out.write('%abc-2.1\n\n')
+        batch = list(itertools.islice(records, batch_size))
+        while batch:
+            keys = []
+            stanzas = []
+            missing = []
+            rows = []
+            for (pae, fields) in batch:
+                key = repeated_identifier(manifest_identifier(pae, fields),
+                                          occurrences)
+                keys.append(key)
+                digest = record_hash(version, pae, fields, debug)
+                row = db.execute('SELECT hash, abc FROM manifest '
+                                 'WHERE id = ?', (key,)).fetchone()
+                if row is not None and row[0] == digest:
+                    stanza = row[1]
+                    if isinstance(fields.get('X'), int):
+                        # Always the first line, renumbered
+                        stanza = 'X: %d%s' % (fields['X'],
+                                              stanza[stanza.index('\n'):])
+                    stanzas.append(stanza)
+                else:
+                    if row is None:
+                        new += 1
+                    else:
+                        changed += 1
+                    # Converted below, all at once
+                    stanzas.append(None)
+                    missing.append((pae, fields))
+                    rows.append((key, digest))
+            count += len(batch)
+            converted = convert_batch(missing, debug, pool, chunksize, cache,
+                                      stats)
+            abc = iter(converted)
+            for stanza in stanzas:
+                if stanza is None:
+                    stanza = next(abc)
+                out.write(stanza)
+                out.write('\n')
+            with db:
+                db.executemany('INSERT OR REPLACE INTO manifest '
+                               'VALUES (?, ?, ?)',
+                               [row + (stanza,)
+                                for (row, stanza) in zip(rows, converted)])
+                db.executemany('INSERT OR IGNORE INTO seen VALUES (?)',
+                               [(key,) for key in keys])
+            batch = list(itertools.islice(records, batch_size))
+        deleted = [key for (key,) in db.execute(
+            'SELECT id FROM manifest WHERE id NOT IN (SELECT id FROM seen) '
+            'ORDER BY id')]
+        with db:
+            db.execute('DELETE FROM manifest '
+                       'WHERE id NOT IN (SELECT id FROM seen)')
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+        db.close()
+    return (count, new, changed, deleted)
+
+
+def convert_pae_file(filename, out=None, jobs=1, debug=False, cache=None,
+                     stats=None, shard=None, checkpoint=None, resume=False):
+    '''Convert a file with PAE entries, with optional ABC fields, and
+    write the abc stanzas to out, standard output by default.  With a
+    (k, N) shard, convert only the k-th of N shards, so that the outputs
+    of all of them, one after the other, are the output of the whole
+    file.  With a Checkpoint, save the progress as it goes, and, if
+    asked to resume, go on from it.'''
+
+    if checkpoint is not None:
+        write_checkpointed_abc(filename, checkpoint, out, jobs, debug, cache,
+                               stats, resume)
+        return
+    if shard is not None:
+        (number, count) = shard
+        write_abc(read_pae_shard(filename, number, count), out, jobs, debug,
+                  cache, stats, header=(number == 1))
+        return
+    with open_input(filename) as f:
+        write_abc(read_pae_records(f), out, jobs, debug, cache, stats)
+    return
+
+
+class Checkpoint(object):
+    '''Keep track, in a JSON file, of how far the conversion of a pae
+    file went: the number of records written, the byte offset in the
+    pae file after the last of them, how many of them were numbered
+    automatically and the size of the output then.  The file is written
+    every so many records or seconds, whatever comes first, and always
+    replaced at once, so that it is never left half written.'''
+
+    def __init__(self, filename, every=1000, interval=60.0):
+        self.filename = filename
+        self.every = every
+        self.interval = interval
+        self.pending = 0
+        self.last = timeit.default_timer()
+
+    def load(self):
+        '''Return the state saved in the checkpoint file, or None if
+        there is none'''
+        if not os.path.isfile(self.filename):
+            return None
+        with io.open(self.filename, encoding='utf-8') as f:
+            return json.load(f)
+
+    def save(self, state):
+        '''Replace the checkpoint file with state'''
+        temporary = '%s.tmp' % (self.filename)
+        with io.open(temporary, 'w', encoding='utf-8') as f:
+            f.write(json.dumps(state, sort_keys=True))
+            f.write('\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporary, self.filename)
+        self.pending = 0
+        self.last = timeit.default_timer()
+
+    def due(self):
+        '''Count one more record, and tell whether it is time to save'''
+        self.pending += 1
+        return (self.pending >= self.every or
+                timeit.default_timer() - self.last >= self.interval)
+
+
+def output_size(out):
+    '''Flush out to disk and return its size, or None if it is not a
+    regular file, like a pipe, whose size cannot be known'''
+    out.flush()
+    fd = out.fileno()
+    if not stat.S_ISREG(os.fstat(fd).st_mode):
+        return None
+    os.fsync(fd)
+    return os.fstat(fd).st_size
+
+
+def read_pae_checkpoints(f, offset, number, positions):
+    '''Yield a (pae, fields) pair for each entry of binary pae file f
+    from byte offset on, numbering entries without X field after
+    number, and append the byte offset after each entry and the last
+    automatic number to positions'''
+    encoding = locale.getpreferredencoding(False)
+    position = [offset]
+
+    def lines():
+        f.seek(offset)
+        for line in f:
+            position[0] += len(line)
+            yield line.decode(encoding)
+
+    for (pae, fields) in read_pae_records(lines(), number):
+        if isinstance(fields.get('X'), int):
+            # Only automatic numbers are not strings
+            number = fields['X']
+        positions.append((position[0], number))
+        yield (pae, fields)
+
+
+def write_checkpointed_abc(filename, checkpoint, out=None, jobs=1,
+                           debug=False, cache=None, stats=None,
+                           resume=False):
+    '''Convert a pae file like convert_pae_file(), saving a checkpoint
+    as it goes.  When resuming, continue after the last record of the
+    checkpoint, dropping any output written after it, so that the
+    output ends up the same as if there had been no interruption.'''
+
+    if out is None:
+        out = sys.stdout
+    if resume:
+        state = checkpoint.load()
+        if state is None:
+            raise ValueError('there is no checkpoint %s to resume from'
+                             % (checkpoint.filename))
+        if state['input'] != os.path.abspath(filename):
+            raise ValueError('checkpoint %s is for %s' %
+                             (checkpoint.filename, state['input']))
+        size = output_size(out)
+        if size is not None and state['output'] is not None:
+            if size < state['output']:
+                raise ValueError('the output is shorter than at the '
+                                 'checkpoint')
+            # Drop what was written after the checkpoint
+            os.ftruncate(out.fileno(), state['output'])
+            os.lseek(out.fileno(), state['output'], os.SEEK_SET)
+    else:
+        out.write('%abc-2.1\n\n')
+        state = {
+            'input': os.path.abspath(filename),
+            'records': 0,
+            'offset': 0,
+            'number': 0,
+            'output': output_size(out),
+            }
+        checkpoint.save(state)
+    positions = collections.deque()
+    with io.open(filename, 'rb') as f:
+        records = read_pae_checkpoints(f, state['offset'], state['number'],
+                                       positions)
+        for (record_id, fields, abc) in convert_records(records, debug, jobs,
+                                                        cache=cache,
+                                                        stats=stats):
+            out.write(abc)
+            out.write('\n')
+            (state['offset'], state['number']) = positions.popleft()
+            state['records'] += 1
+            if checkpoint.due():
+                state['output'] = output_size(out)
+                checkpoint.save(state)
+    state['output'] = output_size(out)
+    checkpoint.save(state)
+    return state['records']
+
+
+def convert_marc_file(filename, out=None, jobs=1, debug=False, cache=None,
+                      stats=None):
+    '''Convert the incipits of a MARC21 file and write the abc
+    stanzas to out, standard output by default'''
+
+    write_abc(read_marc_file(filename), out, jobs, debug, cache, stats)
+    return
+
+
+def convert_marcxml_file(filename, out=None, jobs=1, debug=False,
+                         cache=None, stats=None):
+    '''Convert the incipits of a MARCXML file and write the abc
+    stanzas to out, standard output by default'''
+
+    write_abc(read_marcxml_file(filename), out, jobs, debug, cache, stats)
+    return
+
+
+def serve_request(line, debug=False, cache=None):
+    '''Answer a JSON request of --serve-stdio, a line with an object
+    such as {"id": 1, "pae": "...", "fields": {"T": "..."}}, with a
+    JSON response line holding either the abc stanza or the error.
+    Never raises, whatever the request.'''
+    request_id = None
+    try:
+        request = json.loads(line.decode('utf-8'))
+        if not isinstance(request, dict):
+            raise ValueError('request is not a JSON object')
+        request_id = request.get('id')
+        pae = request.get('pae')
+        if not isinstance(pae, str):
+            raise ValueError('pae is missing or is not a string')
+        fields = request.get('fields', {})
+        if not isinstance(fields, dict):
+            raise ValueError('fields is not a JSON object')
+        abc = None
+        if cache is not None:
+            abc = cache.get(pae)
+        if abc is None:
+            abc = convert_pae(pae)
+            if cache is not None:
+                cache.put(pae, abc)
+        response = {
+            'id': request_id,
+            'abc': abc_stanza(pae, abc, fields, request.get('debug', debug)),
+            }
+    except Exception as error:
+        response = {
+            'id': request_id,
+            'error': {
+                'type': error.__class__.__name__,
+                'message': str(error),
+                },
+            }
+    return json.dumps(response)
+
+
+def serve_stdio(fd_in, out, debug=False, cache=None, chunk_size=64*1024):
+    '''Answer JSON Lines requests read from file descriptor fd_in,
+    until its end, writing a response line to binary file out for each
+    one, in the same order.  All the requests available at once are
+    answered as a batch, with a single write.'''
+
+    pending = b''
+    while True:
+        # Blocks only when there is nothing left to read
+        data = os.read(fd_in, chunk_size)
+        if not data:
+            break
+        lines = (pending + data).split(b'\n')
+        # The last line is not complete yet
+        pending = lines.pop()
+        responses = [serve_request(line, debug, cache)
+                     for line in lines if line.strip()]
+        if responses:
+            out.write(('\n'.join(responses) + '\n').encode('utf-8'))
+            out.flush()
+    if pending.strip():
+        out.write((serve_request(pending, debug, cache) + '\n').encode('utf-8'))
+        out.flush()
     return
 
 
 def main(args):
-    '''Either convert a file or a supplied string as parameter.'''
+    '''Either convert a file or a supplied string as parameter, or
+    serve conversion requests.'''
+
+    set_conversion_limits(args.max_elements, args.max_length)
 
-    if args.file:
-        if os.path.isfile(args.file):
-            convert_pae_file(args.file)
+    if args.serve_stdio:
+        cache = None
+        if args.cache:
+            cache = ConversionCache(args.cache, args.cache_size)
+        try:
+            sys.stdout.flush()
+            with io.open(sys.stdout.fileno(), 'wb', closefd=False) as out:
+                serve_stdio(sys.stdin.fileno(), out, args.debug, cache)
+        finally:
+            if cache is not None:
+                cache.close()
+    elif args.query:
+        index = NgramIndex(args.query)
+        try:
+            results = index.search(args.pae, args.top)
+        except ValueError as error:
+            print('Error: %s' % (error), file=sys.stderr)
+            sys.exit(1)
+        finally:
+            index.close()
+        for (score, record_id, label) in results:
+            print('%.3f  record %d  %s' % (score, record_id, label))
+    elif args.file:
+        if args.file == '-' or os.path.isfile(args.file):
+            if (args.shard or args.record or args.checkpoint) and \
+               args.file != '-' and compressed_file(args.file):
+                print('Error: --shard, --record and --checkpoint need an '
+                      'uncompressed file', file=sys.stderr)
+                sys.exit(1)
+            if args.index:
+                (records, ngrams) = build_ngram_index(
+                    read_records(args.file, args.format), args.index)
+                print('index: %d records, %d distinct n-grams' %
+                      (records, ngrams), file=sys.stderr)
+                return
+            if args.validate:
+                with open_output(args.output) as out:
+                    (records, invalid) = validate_records(
+                        read_records(args.file, args.format), out)
+                print('validate: %d records, %d invalid' %
+                      (records, invalid), file=sys.stderr)
+                if invalid:
+                    sys.exit(1)
+                return
+            if args.npz:
+                try:
+                    (records, notes) = export_npz(
+                        read_records(args.file, args.format), args.npz)
+                except RuntimeError as error:
+                    print('Error: %s' % (error), file=sys.stderr)
+                    sys.exit(1)
+                print('npz: %d records, %d notes' % (records, notes),
+                      file=sys.stderr)
+                return
+            if args.dedup:
+                (clusters, labels) = find_duplicates(
+                    read_records(args.file, args.format), args.threshold,
+                    args.jobs)
+                duplicates = 0
+                for (n, cluster) in enumerate(clusters, 1):
+                    print('cluster %d, %d records' % (n, len(cluster)))
+                    for record_id in cluster:
+                        print('  record %d  %s' % (record_id,
+                                                   labels[record_id - 1]))
+                    print()
+                    duplicates += len(cluster) - 1
+                print('dedup: %d records, %d clusters, %d duplicates' %
+                      (len(labels), len(clusters), duplicates),
+                      file=sys.stderr)
+                return
+            if args.record:
+                records = list(read_indexed_records(args.file, args.record))
+                if not records:
+                    print('Error: no record %s in %s' %
+                          (args.record, args.file), file=sys.stderr)
+                    sys.exit(1)
+                with open_output(args.output) as out:
+                    write_abc(records, out, debug=args.debug)
+                return
+            cache = None
+            if args.cache:
+                cache = ConversionCache(args.cache, args.cache_size)
+            stats = None
+            if args.stats:
+                stats = ConversionStats(args.slowest)
+            if args.sqlite:
+                if args.shard:
+                    records = read_pae_shard(args.file, *args.shard)
+                else:
+                    records = read_records(args.file, args.format)
+                try:
+                    records = write_sqlite(records, args.sqlite, args.jobs,
+                                           args.debug, cache, stats)
+                finally:
+                    if cache is not None:
+                        cache.close()
+                        print(cache.stats(), file=sys.stderr)
+                    if stats is not None:
+                        print(stats.report(), file=sys.stderr)
+                print('sqlite: %d records' % (records), file=sys.stderr)
+                return
+            if args.manifest:
+                try:
+                    with open_output(args.output) as out:
+                        (records, new, changed,
+                         deleted) = write_manifest_abc(
+                             read_records(args.file, args.format),
+                             args.manifest, out, args.jobs, args.debug,
+                             cache, stats)
+                except ValueError as error:
+                    print('Error: %s' % (error), file=sys.stderr)
+                    sys.exit(1)
+                finally:
+                    if cache is not None:
+                        cache.close()
+                        print(cache.stats(), file=sys.stderr)
+                    if stats is not None:
+                        print(stats.report(), file=sys.stderr)
+                for key in deleted:
+                    print('deleted: %s' % (key), file=sys.stderr)
+                print('manifest: %d records, %d new, %d changed, %d deleted' %
+                      (records, new, changed, len(deleted)), file=sys.stderr)
+                return
+            checkpoint = None
+            if args.checkpoint:
+                checkpoint = Checkpoint(args.checkpoint, args.checkpoint_every,
+                                        args.checkpoint_interval)
+            try:
+                with open_output(args.output, append=args.resume) as out:
+                    if args.format == 'marc':
+                        convert_marc_file(args.file, out, args.jobs,
+                                          args.debug, cache, stats)
+                    elif args.format == 'marcxml':
+                        convert_marcxml_file(args.file, out, args.jobs,
+                                             args.debug, cache, stats)
+                    else:
+                        convert_pae_file(args.file, out, args.jobs,
+                                         args.debug, cache, stats,
+                                         args.shard, checkpoint, args.resume)
+            except ValueError as error:
+                print('Error: %s' % (error), file=sys.stderr)
+                sys.exit(1)
+            finally:
+                if cache is not None:
+                    cache.close()
+                    print(cache.stats(), file=sys.stderr)
+                if stats is not None:
+                    print(stats.report(), file=sys.stderr)
         else:
             print('Error: %s not found' % (args.file), file=sys.stderr)
             sys.exit(1)
     elif args.pae:
-        abc = pae2abc(args.pae)
+        try:
+            abc = pae2abc(args.pae, debug=args.debug)
+        except ValueError as error:
+            print('Error: %s' % (error), file=sys.stderr)
+            sys.exit(1)
         print(abc)
         
 
@@ -605,17 +3525,172 @@ if __name__ == '__main__':
     parser.add_argument('-f', '--file',
                         nargs='?',
                         default='',
-                        help='input file')
+                        help='input file, or - for standard input')
+    parser.add_argument('--marc',
+                        dest='format',
+                        action='store_const',
+                        const='marc',
+                        default='pae',
+                        help='input file is MARC21 (ISO 2709)')
+    parser.add_argument('--marcxml',
+                        dest='format',
+                        action='store_const',
+                        const='marcxml',
+                        help='input file is MARCXML')
     parser.add_argument('-d', '--debug',
                         action='store_true',
                         default=False,
                         help='debug mode')
+    parser.add_argument('-j', '--jobs',
+                        type=int,
+                        default=1,
+                        help='number of processes to convert a file with')
+    parser.add_argument('--cache',
+                        default='',
+                        help='SQLite file to keep converted incipits in')
+    parser.add_argument('--cache-size',
+                        type=int,
+                        default=10000,
+                        help='number of converted incipits kept in memory')
+    parser.add_argument('--stats',
+                        action='store_true',
+                        default=False,
+                        help='report conversion times, constructs found '
+                        'and the slowest records of --file to stderr')
+    parser.add_argument('--slowest',
+                        type=int,
+                        default=10,
+                        help='number of slowest records that --stats '
+                        'reports')
+    parser.add_argument('--shard',
+                        type=shard_arg,
+                        metavar='k/N',
+                        help='convert only the k-th of N parts of a pae '
+                        '--file, to split it between several machines')
+    parser.add_argument('--checkpoint',
+                        default='',
+                        metavar='FILE',
+                        help='save how far the conversion of a pae --file '
+                        'went to FILE, to --resume it if interrupted')
+    parser.add_argument('--checkpoint-every',
+                        type=int,
+                        default=1000,
+                        metavar='RECORDS',
+                        help='save the --checkpoint every RECORDS records')
+    parser.add_argument('--checkpoint-interval',
+                        type=float,
+                        default=60.0,
+                        metavar='SECONDS',
+                        help='save the --checkpoint every SECONDS seconds '
+                        'too')
+    parser.add_argument('--resume',
+                        action='store_true',
+                        default=False,
+                        help='go on from the --checkpoint, appending to the '
+                        'output')
+    parser.add_argument('-o', '--output',
+                        default='',
+                        metavar='FILE',
+                        help='write to FILE instead of standard output, '
+                        'compressed if it ends in .gz, .bz2 or .xz')
+    parser.add_argument('--sqlite',
+                        default='',
+                        metavar='DB',
+                        help='write the records of --file, converted, to '
+                        'the SQLite database DB instead of standard output')
+    parser.add_argument('--manifest',
+                        default='',
+                        metavar='FILE',
+                        help='keep a hash and the abc stanza of every '
+                        'record of --file in the SQLite file FILE, and '
+                        'convert only new or changed ones next time')
+    parser.add_argument('--record',
+                        default='',
+                        metavar='ID',
+                        help='convert only the records of a pae --file '
+                        'with X or P field ID, or its ID-th one for #ID, '
+                        'through an index kept in FILE.records')
+    parser.add_argument('--max-elements',
+                        type=int,
+                        default=max_tune_elements,
+                        help='refuse incipits whose repeats expand to more '
+                        'abc elements than this')
+    parser.add_argument('--max-length',
+                        type=int,
+                        default=max_abc_length,
+                        help='refuse incipits whose abc tune is longer '
+                        'than this')
+    parser.add_argument('--serve-stdio',
+                        action='store_true',
+                        default=False,
+                        help='answer JSON Lines conversion requests from '
+                        'standard input until its end')
+    parser.add_argument('--index',
+                        default='',
+                        metavar='FILE',
+                        help='write an n-gram index of the melodies of '
+                        '--file to FILE, instead of converting it')
+    parser.add_argument('--query',
+                        default='',
+                        metavar='FILE',
+                        help='search the pae string in the n-gram index '
+                        'FILE, and print the best matching records')
+    parser.add_argument('--top',
+                        type=int,
+                        default=10,
+                        help='number of records that --query prints')
+    parser.add_argument('--dedup',
+                        action='store_true',
+                        default=False,
+                        help='print clusters of records of --file with '
+                        'nearly the same melody, instead of converting it')
+    parser.add_argument('--threshold',
+                        type=float,
+                        default=0.8,
+                        help='how similar --dedup records must be, from '
+                        '0 to 1')
+    parser.add_argument('--validate',
+                        action='store_true',
+                        default=False,
+                        help='check the records of --file without '
+                        'converting them, and write a JSON line for each '
+                        'invalid one')
+    parser.add_argument('--npz',
+                        default='',
+                        metavar='FILE',
+                        help='write the pitches, lengths and bars of the '
+                        'notes of --file as NumPy arrays to FILE, instead '
+                        'of converting it')
     parser.add_argument('pae',
                         nargs='?',
                         default='',
                         action='store')
     args = parser.parse_args()
-    if not args.file and not args.pae:
-        parser.error('Either --file or a pae string are required')
+    if args.shard and (args.format != 'pae' or args.file in ('', '-')):
+        parser.error('--shard needs a pae --file, not standard input')
+    if args.checkpoint and (args.format != 'pae' or
+                            args.file in ('', '-')):
+        parser.error('--checkpoint needs a pae --file, not standard input')
+    if args.checkpoint and args.output and \
+       os.path.splitext(args.output)[1] in compression_extensions:
+        parser.error('--checkpoint cannot be used with a compressed '
+                     '--output')
+    if args.checkpoint and args.sqlite:
+        parser.error('--checkpoint cannot be used with --sqlite')
+    if args.checkpoint and args.shard:
+        parser.error('--checkpoint cannot be used with --shard')
+    if args.manifest and (args.shard or args.checkpoint or args.sqlite or
+                          args.record):
+        parser.error('--manifest cannot be used with --shard, --checkpoint, '
+                     '--sqlite or --record')
+    if args.resume and not args.checkpoint:
+        parser.error('--resume needs a --checkpoint')
+    if args.record and (args.format != 'pae' or args.file in ('', '-')):
+        parser.error('--record needs a pae --file, not standard input')
+    if args.query and not args.pae:
+        parser.error('--query needs a pae string to search')
+    if not args.file and not args.pae and not args.serve_stdio:
+        parser.error('Either --file, --serve-stdio or a pae string are '
+                     'required')
 
     main(args)